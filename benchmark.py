@@ -0,0 +1,416 @@
+#!/usr/bin/python3
+"""
+Offline benchmark of the Bluetooth HID service.
+The service runs in a child process on a private dbus-daemon. Its hosts
+are the service ends of AF_UNIX SOCK_SEQPACKET socket pairs instead of
+L2CAP connections, the other ends are read by fake hosts that decode and
+timestamp every report. No adapter, radio or paired host is needed.
+Results are written as JSON.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import dbus
+import dbus.bus
+from gi.repository import GLib
+from dbus.mainloop.glib import DBusGMainLoop
+
+import btk_server
+from hid_descriptor import MOUSE
+from report_transport import ReportSocket
+
+HID_DBUS = 'org.yaptb.btkbservice'
+HID_SRVC = '/org/yaptb/btkbservice'
+
+HOST_ADDRESS = '00:00:00:00:00:01'
+
+
+class LoopbackDevice(btk_server.BTKbDevice):
+    """
+    BTKbDevice without an adapter, its host is connected over socket pairs
+    """
+
+    def __init__(self, ccontrol, cinterrupt):
+        self.loopback = (ccontrol, cinterrupt)
+        super().__init__()
+
+    def setup_adapter(self):
+        pass
+
+    def listen(self):
+        ccontrol, cinterrupt = self.loopback
+        connection = btk_server.HostConnection(self, HOST_ADDRESS)
+        connection.attach_control(ccontrol)
+        connection.attach_interrupt(cinterrupt)
+        self.connections[HOST_ADDRESS] = connection
+
+
+class FakeHost(threading.Thread):
+    """
+    Host end of the interrupt channel, keeps every report with the time
+    it arrived
+    """
+
+    def __init__(self, sock):
+        super().__init__(daemon=True)
+        self.sock = sock
+        self.received = []
+        self.arrived = threading.Condition()
+
+    def run(self):
+        while True:
+            try:
+                data = self.sock.recv(btk_server.MAX_REPORT_SIZE)
+            except OSError:
+                return
+            if not data:
+                return
+            now = time.monotonic()
+            with self.arrived:
+                self.received.append((now, data))
+                self.arrived.notify()
+
+    def take(self, done, timeout=10.0):
+        """
+        Wait for reports
+        :param done: function of the received reports, True when the
+        expected reports have arrived
+        :return: list of (time, report)
+        """
+        deadline = time.monotonic() + timeout
+        with self.arrived:
+            while not done(self.received):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.arrived.wait(remaining)
+            received, self.received = self.received, []
+        return received
+
+
+class DrainHost(threading.Thread):
+    """
+    Host end of the interrupt channel that only counts the reports, so it
+    does not add allocations of its own to the measurements
+    """
+
+    def __init__(self, sock):
+        super().__init__(daemon=True)
+        self.sock = sock
+        self.buffer = bytearray(btk_server.MAX_REPORT_SIZE)
+        self.count = 0
+
+    def run(self):
+        while True:
+            try:
+                if not self.sock.recv_into(self.buffer):
+                    return
+            except OSError:
+                return
+            self.count += 1
+
+    def wait(self, count, timeout=10.0):
+        deadline = time.monotonic() + timeout
+        while self.count < count and time.monotonic() < deadline:
+            time.sleep(0.001)
+
+
+def decode_report(data):
+    """
+    Decode a report the way a host would
+    :return: dict with the report fields
+    """
+    if data[1] == btk_server.KEYBOARD_REPORT:
+        return {'type': 'keyboard', 'modifiers': data[2],
+                'keys': [key for key in data[4:10] if key]}
+    if data[1] == btk_server.MOUSE_REPORT:
+        buttons, x, y, wheel = MOUSE.unpack(data)
+        return {'type': 'mouse', 'buttons': buttons, 'x': x, 'y': y,
+                'wheel': wheel}
+    return {'type': 'unknown', 'id': data[1]}
+
+
+def keyboard_report(seq):
+    """
+    Keyboard report with seq encoded in the key slots, usages stay
+    within the range of the boot keyboard
+    """
+    keys = [4 + seq % 96, 4 + seq // 96 % 96, 4 + seq // 9216 % 96]
+    return bytes([0xA1, btk_server.KEYBOARD_REPORT, 0, 0, *keys, 0, 0, 0])
+
+
+def keyboard_seq(report):
+    keys = report['keys']
+    return (keys[0] - 4) + (keys[1] - 4) * 96 + (keys[2] - 4) * 9216
+
+
+RELEASE_REPORT = bytes([0xA1, btk_server.KEYBOARD_REPORT] + [0] * 8)
+MOUSE_STEP_REPORT = bytes([0xA1, btk_server.MOUSE_REPORT, 0, 1, 0, 0])
+
+
+def summarize(count, start, received, latencies):
+    """
+    :param count: reports sent by the client
+    :param start: time the first report was sent
+    :param received: list of (time, report) that reached the host
+    :param latencies: seconds from client send to host receive
+    """
+    elapsed = (received[-1][0] if received else time.monotonic()) - start
+    latencies = sorted(latencies)
+
+    def percentile(fraction):
+        if not latencies:
+            return None
+        index = min(len(latencies) - 1, int(fraction * len(latencies)))
+        return latencies[index] * 1000000
+
+    return {
+        'reports': count,
+        'received': len(received),
+        'seconds': elapsed,
+        'reports_per_sec': count / elapsed if elapsed > 0 else None,
+        'latency_us': {
+            'mean': sum(latencies) / len(latencies) * 1000000
+            if latencies else None,
+            'p50': percentile(0.5),
+            'p90': percentile(0.9),
+            'p99': percentile(0.99),
+            'max': latencies[-1] * 1000000 if latencies else None,
+        },
+    }
+
+
+def bench_keys(send, host, count):
+    """
+    Distinct keyboard reports as fast as the client can send them
+    """
+    sent = [0.0] * count
+    start = time.monotonic()
+    for seq in range(count):
+        sent[seq] = time.monotonic()
+        send(keyboard_report(seq))
+    received = host.take(lambda reports: len(reports) >= count)
+    latencies = [arrived - sent[keyboard_seq(decode_report(data))]
+                 for arrived, data in received]
+    return summarize(count, start, received, latencies)
+
+
+def bench_typing(send, host, count):
+    """
+    Key press and release pairs, like typing a text
+    """
+    sent = [0.0] * count
+    start = time.monotonic()
+    for seq in range(count):
+        sent[seq] = time.monotonic()
+        send(keyboard_report(seq))
+        send(RELEASE_REPORT)
+    received = host.take(lambda reports: len(reports) >= 2 * count)
+    latencies = []
+    for arrived, data in received:
+        report = decode_report(data)
+        if report['keys']:
+            latencies.append(arrived - sent[keyboard_seq(report)])
+    return summarize(2 * count, start, received, latencies)
+
+
+def bench_mouse(send, host, count):
+    """
+    Mouse movement of one count per report. Reports merged by the
+    service are matched with the newest movement they carry
+    """
+    sent = [0.0] * count
+    start = time.monotonic()
+    for seq in range(count):
+        sent[seq] = time.monotonic()
+        send(MOUSE_STEP_REPORT)
+
+    def moved(reports):
+        return sum(decode_report(data)['x'] for _, data in reports) >= count
+
+    received = host.take(moved)
+    latencies = []
+    position = 0
+    for arrived, data in received:
+        position += decode_report(data)['x']
+        latencies.append(arrived - sent[min(position, count) - 1])
+    return summarize(count, start, received, latencies)
+
+
+def bench_hot_path(count):
+    """
+    BTKbDevice.send in this process, without D-Bus: reports as new bytes
+    objects, as the D-Bus methods get them, and as slices of a reused
+    buffer, as the report socket passes them on. Time per report, and
+    memory allocated while sending with tracemalloc
+    """
+    reports = [keyboard_report(seq) for seq in range(count)]
+    context = GLib.MainContext.default()
+    results = {}
+    for name in ('bytes', 'memoryview'):
+        control = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        interrupt = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        device = LoopbackDevice(control[0], interrupt[0])
+        device.listen()
+        connection = device.connections[HOST_ADDRESS]
+        host = DrainHost(interrupt[1])
+        host.start()
+        buffer = bytearray(btk_server.MAX_REPORT_SIZE)
+        view = memoryview(buffer)
+
+        def send_all():
+            for report in reports:
+                if name == 'memoryview':
+                    size = len(report)
+                    buffer[:size] = report
+                    report = view[:size]
+                device.send(report)
+                # the main loop of the service drains a full channel
+                while connection.write_watch is not None:
+                    context.iteration(True)
+
+        start = time.perf_counter()
+        send_all()
+        elapsed = time.perf_counter() - start
+        host.wait(count)
+
+        tracemalloc.start()
+        before, _ = tracemalloc.get_traced_memory()
+        send_all()
+        after, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        host.wait(2 * count)
+
+        results[name] = {
+            'reports': count,
+            'received': host.count,
+            'us_per_report': elapsed / count * 1000000,
+            'peak_alloc_bytes': peak - before,
+            'retained_bytes': after - before,
+        }
+        connection.close()
+        for sock in control + interrupt:
+            sock.close()
+    return results
+
+
+def run_service(address, ccontrol, cinterrupt, report_socket_path, ready):
+    """
+    Child process running the service on the private bus
+    """
+    DBusGMainLoop(set_as_default=True)
+    bus = dbus.bus.BusConnection(address)
+    device = LoopbackDevice(ccontrol, cinterrupt)
+    btk_server.BTKbService(stats_interval=0, bus=bus, devices=[device],
+                           report_socket_path=report_socket_path)
+    ready.set()
+    GLib.MainLoop().run()
+
+
+def start_bus():
+    """
+    Start a private dbus-daemon
+    :return: (Popen, address)
+    """
+    daemon = subprocess.Popen(['dbus-daemon', '--session', '--nofork',
+                               '--print-address=1'],
+                              stdout=subprocess.PIPE,
+                              universal_newlines=True)
+    address = daemon.stdout.readline().strip()
+    if not address:
+        sys.exit('Could not start dbus-daemon')
+    return daemon, address
+
+
+def run(count):
+    daemon, address = start_bus()
+    workdir = tempfile.mkdtemp(prefix='btk-bench-')
+    report_socket_path = os.path.join(workdir, 'reports.sock')
+
+    control = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    interrupt = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+
+    context = multiprocessing.get_context('fork')
+    ready = context.Event()
+    service = context.Process(target=run_service,
+                              args=(address, control[0], interrupt[0],
+                                    report_socket_path, ready),
+                              daemon=True)
+    service.start()
+    control[0].close()
+    interrupt[0].close()
+
+    results = {}
+    try:
+        if not ready.wait(10):
+            sys.exit('The service did not start')
+        host = FakeHost(interrupt[1])
+        host.start()
+
+        bus = dbus.bus.BusConnection(address)
+        iface = dbus.Interface(bus.get_object(HID_DBUS, HID_SRVC), HID_DBUS)
+        report_socket = ReportSocket(report_socket_path)
+
+        def send_keys(report):
+            iface.send_keys(dbus.ByteArray(report), signature='ay')
+
+        def send_mouse(report):
+            iface.send_mouse(dbus.ByteArray(report), signature='ay')
+
+        results['send_keys'] = bench_keys(send_keys, host, count)
+        results['send_mouse'] = bench_mouse(send_mouse, host, count)
+        results['typing'] = bench_typing(send_keys, host, count // 2)
+        results['socket_keys'] = bench_keys(report_socket.send, host, count)
+        results['socket_typing'] = bench_typing(report_socket.send, host,
+                                                count // 2)
+        results['mouse_burst'] = bench_mouse(report_socket.send, host,
+                                             count)
+        results['counters'] = {str(name): int(value) for name, value
+                               in iface.get_counters().items()}
+        report_socket.close()
+    finally:
+        service.terminate()
+        service.join()
+        daemon.terminate()
+        daemon.wait()
+        for sock in (control[1], interrupt[1]):
+            sock.close()
+        if os.path.exists(report_socket_path):
+            os.unlink(report_socket_path)
+        os.rmdir(workdir)
+
+    return results
+
+
+parser = argparse.ArgumentParser(
+    description="Measure throughput and latency of the HID service without Bluetooth hardware")
+parser.add_argument('--count', default=5000, type=int, help="reports per benchmark. Default is 5000")
+parser.add_argument('--output', default=None, type=str, help="file to write the JSON results to. Default is stdout")
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    output = {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'count': args.count,
+        'results': run(args.count),
+        'hot_path': bench_hot_path(args.count),
+    }
+    text = json.dumps(output, indent=2)
+    if args.output:
+        with open(args.output, 'w') as fh:
+            fh.write(text + '\n')
+    else:
+        print(text)
@@ -5,9 +5,16 @@ Original idea taken from:
 http://yetanotherpointlesstechblog.blogspot.com/2016/04/emulating-bluetooth-keyboard-with.html
 Moved to Python 3 and tested with BlueZ 5.43
 """
+import argparse
+import logging
+import logging.handlers
 import os
 import sys
 import time
+import collections
+import errno
+import math
+from queue import SimpleQueue
 
 import dbus
 import dbus.service
@@ -19,6 +26,244 @@ from dbus.mainloop.glib import DBusGMainLoop
 
 import xml.etree.ElementTree as ET
 
+from report_transport import REPORT_SOCKET_PATH, MAX_REPORT_SIZE, \
+    TRACE_MAGIC, TRACE_HEADER
+from tracing import LatencyHistogram, LatencyTracer, TracedReport
+from known_hosts import KnownHosts, KNOWN_HOSTS_PATH
+from profiling import Profiler, HotPathTimers, CPROFILE
+from report_state import ReportState
+import hid_descriptor
+import keymap
+
+logger = logging.getLogger('btk_server')
+
+# Report IDs, see hid_descriptor
+KEYBOARD_REPORT = hid_descriptor.KEYBOARD.report_id
+MOUSE_REPORT = hid_descriptor.MOUSE.report_id
+HIRES_MOUSE_REPORT = hid_descriptor.HIRES_MOUSE.report_id
+# reports that move something, they are merged instead of queued in order
+RELATIVE_REPORTS = hid_descriptor.relative_fields()
+
+# HIDP control channel: message types in the high nibble of the header
+HIDP_HANDSHAKE = 0x0
+HIDP_HID_CONTROL = 0x1
+HIDP_GET_REPORT = 0x4
+HIDP_SET_REPORT = 0x5
+HIDP_GET_PROTOCOL = 0x6
+HIDP_SET_PROTOCOL = 0x7
+HIDP_GET_IDLE = 0x8
+HIDP_SET_IDLE = 0x9
+HIDP_DATA = 0xA
+# report type in the low nibble of GET_REPORT, SET_REPORT and DATA
+HIDP_OTHER = 0x0
+HIDP_INPUT = 0x1
+HIDP_OUTPUT = 0x2
+HIDP_FEATURE = 0x3
+# GET_REPORT flag: the largest reply wanted follows the report ID
+HIDP_GET_REPORT_SIZE = 0x8
+# HANDSHAKE results
+HIDP_SUCCESSFUL = 0x0
+HIDP_INVALID_REPORT_ID = 0x2
+HIDP_UNSUPPORTED_REQUEST = 0x3
+HIDP_INVALID_PARAMETER = 0x4
+# HID_CONTROL operations
+HIDP_SUSPEND = 0x3
+HIDP_EXIT_SUSPEND = 0x4
+HIDP_VIRTUAL_CABLE_UNPLUG = 0x5
+# protocols of GET_PROTOCOL and SET_PROTOCOL
+BOOT_PROTOCOL = 0
+REPORT_PROTOCOL = 1
+# milliseconds per unit of the SET_IDLE rate
+IDLE_RATE_UNIT = 4
+
+# bit shift of the wheel and pan Resolution Multipliers in the feature
+# report of the high resolution mouse
+WHEEL_MULTIPLIER_SHIFTS = (0, 2)
+# feature report value with both multipliers on
+HIRES_WHEELS = 0x05
+
+# times measured from the service start or the loss of a link, or from
+# the host opening the control channel: until the interrupt channel is
+# up, and until the first report has been sent to the host
+CONNECT_STAGES = ('connect', 'first_report')
+
+
+class InvalidArgsError(dbus.DBusException):
+    """
+    The arguments of a method call can not be used
+    """
+    _dbus_error_name = 'org.yaptb.btkbservice.Error.InvalidArgs'
+
+
+class CancelledError(dbus.DBusException):
+    """
+    Queued reports were cancelled before they were all sent
+    """
+    _dbus_error_name = 'org.yaptb.btkbservice.Error.Cancelled'
+
+
+class BusyError(dbus.DBusException):
+    """
+    A host is not taking reports fast enough, the report was not queued
+    and can be sent again later
+    """
+    _dbus_error_name = 'org.yaptb.btkbservice.Error.Busy'
+
+
+class SendQueue:
+    """
+    Reports waiting for the interrupt channel of one host.
+    Keyboard and other reports keep their order, are never dropped and go
+    out before any mouse report. Mouse motion is never dropped either:
+    it is added up per button state and split into as many reports as
+    the fields need when it is sent, the way TickScheduler does.
+    """
+    # ordered reports a host can fall behind before new ones are refused
+    ORDERED_LIMIT = 256
+    # mouse button states kept, beyond this the oldest one is dropped and
+    # its motion is added to the next one
+    MOUSE_LIMIT = 32
+
+    def __init__(self, counters):
+        self.ordered = collections.deque()
+        # waiting mouse states: [bytes before the movement, bytes after
+        # it, movement, trace of the oldest input or None]
+        self.mouse = collections.deque()
+        self.counters = counters
+
+    def __len__(self):
+        return len(self.ordered) + len(self.mouse)
+
+    def full(self, msg):
+        """
+        :return: True if msg has to be refused to keep the queue bounded
+        """
+        return msg[1] not in RELATIVE_REPORTS \
+            and len(self.ordered) >= self.ORDERED_LIMIT
+
+    def push(self, msg):
+        relative = RELATIVE_REPORTS.get(msg[1])
+        if relative is None:
+            self.ordered.append(msg)
+            return
+        moves = hid_descriptor.REPORTS[msg[1]].relative_struct.unpack(
+            msg[relative])
+        head = bytes(msg[:relative.start])
+        tail = bytes(msg[relative.stop:])
+        trace = msg.trace if type(msg) is TracedReport else None
+        if self.mouse and self.mouse[-1][0] == head \
+                and self.mouse[-1][1] == tail:
+            state = self.mouse[-1]
+            for index, move in enumerate(moves):
+                state[2][index] += move
+            if state[3] is None:
+                state[3] = trace
+            self.counters['merged'] += 1
+            return
+        self.mouse.append([head, tail, list(moves), trace])
+        if len(self.mouse) > self.MOUSE_LIMIT:
+            # only the buttons of the oldest state are lost
+            oldest = self.mouse.popleft()
+            state = self.mouse[0]
+            for index, move in enumerate(oldest[2]):
+                state[2][index] += move
+            if oldest[3] is not None:
+                state[3] = oldest[3]
+            self.counters['dropped'] += 1
+
+    @staticmethod
+    def _steps(state):
+        """
+        :return: the movement of the next report of a mouse state, as
+        much as its fields hold
+        """
+        definition = hid_descriptor.REPORTS[state[0][1]]
+        return [max(low, min(high, move)) for move, (low, high)
+                in zip(state[2], definition.relative_limits)]
+
+    def peek(self):
+        """
+        :return: the next report to send
+        """
+        if self.ordered:
+            return self.ordered[0]
+        head, tail, _, trace = state = self.mouse[0]
+        definition = hid_descriptor.REPORTS[head[1]]
+        report = head + definition.relative_struct.pack(
+            *self._steps(state)) + tail
+        return TracedReport(report, trace) if trace is not None else report
+
+    def pop(self):
+        """
+        Remove the report returned by peek, once it has been sent
+        """
+        if self.ordered:
+            self.ordered.popleft()
+            return
+        state = self.mouse[0]
+        # what did not fit in the report waits for the next one
+        rest = [move - step for move, step
+                in zip(state[2], self._steps(state))]
+        if any(rest):
+            state[2] = rest
+            state[3] = None
+        else:
+            self.mouse.popleft()
+
+    def clear(self):
+        self.ordered.clear()
+        self.mouse.clear()
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Let a warning from the same place through at most once per interval.
+    Repeats in between are counted and reported with the next one
+    """
+
+    def __init__(self, interval=5.0):
+        super().__init__()
+        self.interval = interval
+        self.last = {}  # (time, suppressed) by call site
+
+    def filter(self, record):
+        if record.levelno < logging.WARNING:
+            return True
+        key = (record.pathname, record.lineno)
+        now = time.monotonic()
+        last, suppressed = self.last.get(key, (-self.interval, 0))
+        if now - last < self.interval:
+            self.last[key] = (last, suppressed + 1)
+            return False
+        if suppressed:
+            record.msg = '{} ({} similar messages suppressed)'.format(
+                record.getMessage(), suppressed)
+            record.args = ()
+        self.last[key] = (now, 0)
+        return True
+
+
+def setup_logging(level):
+    """
+    Send log records through a queue to a background thread, so nothing
+    in the main loop waits for the console or journald
+    :param level: (str) name of the lowest level to log
+    :return: (QueueListener) the started listener thread
+    """
+    handler = logging.StreamHandler()
+    handler.setFormatter(
+        logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+    records = SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(records)
+    queue_handler.addFilter(RateLimitFilter())
+    root = logging.getLogger()
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+    listener = logging.handlers.QueueListener(records, handler)
+    listener.start()
+    return listener
+
+
 class HumanInterfaceDeviceProfile(dbus.service.Object):
     """
     BlueZ D-Bus Profile for HID
@@ -28,31 +273,479 @@ class HumanInterfaceDeviceProfile(dbus.service.Object):
     @dbus.service.method('org.bluez.Profile1',
                          in_signature='', out_signature='')
     def Release(self):
-            print('Release')
+            logger.info('Release')
             mainloop.quit()
 
     @dbus.service.method('org.bluez.Profile1',
                          in_signature='oha{sv}', out_signature='')
     def NewConnection(self, path, fd, properties):
             self.fd = fd.take()
-            print('NewConnection({}, {})'.format(path, self.fd))
+            logger.info('NewConnection({}, {})'.format(path, self.fd))
             for key in properties.keys():
                     if key == 'Version' or key == 'Features':
-                            print('  {} = 0x{:04x}'.format(key,
-                                                           properties[key]))
+                            logger.info('  {} = 0x{:04x}'.format(
+                                key, properties[key]))
                     else:
-                            print('  {} = {}'.format(key, properties[key]))
+                            logger.info('  {} = {}'.format(key, properties[key]))
 
     @dbus.service.method('org.bluez.Profile1',
                          in_signature='o', out_signature='')
     def RequestDisconnection(self, path):
-            print('RequestDisconnection {}'.format(path))
+            logger.info('RequestDisconnection {}'.format(path))
 
             if self.fd > 0:
                     os.close(self.fd)
                     self.fd = -1
 
 
+class HostConnection:
+    """
+    Control and interrupt channel of one connected host.
+    Each host has its own send queue that is drained when its interrupt
+    channel is writable, so a slow host does not hold up the others.
+    """
+    # backoff between reconnect attempts in seconds
+    RECONNECT_MIN_DELAY = 0.5
+    RECONNECT_MAX_DELAY = 30
+    # attempts before giving up, the host can still connect by itself
+    RECONNECT_MAX_ATTEMPTS = 20
+
+    def __init__(self, device, address):
+        self.device = device
+        self.address = address
+        self.ccontrol = None  # Socket object for control
+        self.cinterrupt = None  # Socket object for interrupt
+        self.counters = collections.Counter()
+        self.logged = collections.Counter()  # counters at the last log
+        self.queue = SendQueue(self.counters)
+        # last report sent, for clients that send unchanged reports
+        self.report_state = ReportState() if device.dedup else None
+        self.watches = []  # GLib sources watching the channels
+        self.write_watch = None
+        # outgoing connection state, see connect()
+        self.reconnect_delay = self.RECONNECT_MIN_DELAY
+        self.reconnect_id = None
+        self.reconnect_attempts = 0
+        self.connecting = None
+        # start of the connection for the connect times, None once the
+        # first report has been sent
+        self.since = time.monotonic()
+        # Resolution Multiplier feature of the high resolution mouse as
+        # set by the host, and the wheel and pan counts that did not make
+        # a whole detent yet while a multiplier is off
+        self.multipliers = 0
+        self.wheel_rest = [0, 0]
+        # protocol set by the host, in boot protocol reports are converted
+        # to the boot keyboard and boot mouse reports
+        self.protocol = REPORT_PROTOCOL
+        # last report sent of each report ID that does not move anything,
+        # for GET_REPORT, and the ID and time of the latest one, repeated
+        # when the host has set an idle rate
+        self.last_reports = {}
+        self.last_id = None
+        self.last_time = 0
+        self.idle_rate = 0
+        self.idle_id = None
+        # keyboard LEDs set by the host
+        self.leds = 0
+
+    @property
+    def connected(self):
+        return self.cinterrupt is not None
+
+    def attach_control(self, sock):
+        self.ccontrol = sock
+        # requests are answered before reports are sent
+        self._watch(sock, GLib.PRIORITY_HIGH)
+
+    def attach_interrupt(self, sock):
+        sock.setblocking(False)
+        self.cinterrupt = sock
+        self._watch(sock)
+        self.device.on_connect(self)
+
+    def _watch(self, sock, priority=GLib.PRIORITY_DEFAULT):
+        self.watches.append(
+            GLib.io_add_watch(sock.fileno(), priority,
+                              GLib.IO_IN | GLib.IO_HUP | GLib.IO_ERR,
+                              self._channel_event, sock))
+
+    def _channel_event(self, fd, condition, sock):
+        if condition & GLib.IO_IN:
+            try:
+                data = sock.recv(MAX_REPORT_SIZE, socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                return True
+            except OSError:
+                data = b''
+            if data:
+                if sock is self.ccontrol:
+                    self._control(data)
+                elif data[0] == hid_descriptor.DATA_OUTPUT:
+                    self._output(data)
+                return True
+        self.device.on_disconnect(self)
+        return False
+
+    def _control(self, data):
+        """
+        Answer a request of the host on the control channel. Every
+        request but HID_CONTROL gets a HANDSHAKE or DATA reply at once
+        """
+        kind = data[0] >> 4
+        param = data[0] & 0x0F
+        if kind == HIDP_HANDSHAKE:
+            return
+        if kind == HIDP_HID_CONTROL:
+            self._hid_control(param)
+        elif kind == HIDP_GET_REPORT:
+            self._get_report(data)
+        elif kind == HIDP_SET_REPORT:
+            self._set_report(data)
+        elif kind == HIDP_GET_PROTOCOL:
+            self._reply(bytes([HIDP_DATA << 4 | HIDP_OTHER, self.protocol]))
+        elif kind == HIDP_SET_PROTOCOL:
+            self.protocol = param & 0x01
+            logger.info('{} set the {} protocol'.format(
+                self.address,
+                'boot' if self.protocol == BOOT_PROTOCOL else 'report'))
+            self._handshake(HIDP_SUCCESSFUL)
+        elif kind == HIDP_GET_IDLE:
+            self._reply(bytes([HIDP_DATA << 4 | HIDP_OTHER, self.idle_rate]))
+        elif kind == HIDP_SET_IDLE and len(data) == 2:
+            self._set_idle(data[1])
+            self._handshake(HIDP_SUCCESSFUL)
+        elif kind == HIDP_SET_IDLE:
+            self._handshake(HIDP_INVALID_PARAMETER)
+        else:
+            self._handshake(HIDP_UNSUPPORTED_REQUEST)
+
+    def _hid_control(self, operation):
+        if operation == HIDP_VIRTUAL_CABLE_UNPLUG:
+            logger.info('{} unplugged the virtual cable'.format(
+                self.address))
+            self.device.on_disconnect(self, reconnect=False)
+        elif operation in (HIDP_SUSPEND, HIDP_EXIT_SUSPEND):
+            logger.info('{} {}'.format(
+                self.address,
+                'suspended' if operation == HIDP_SUSPEND else 'resumed'))
+
+    def _get_report(self, data):
+        """
+        Reply with the current input report, the keyboard LEDs or the
+        Resolution Multiplier feature
+        """
+        report_type = data[0] & 0x03
+        if report_type == HIDP_OTHER:
+            self._handshake(HIDP_INVALID_PARAMETER)
+            return
+        definition = hid_descriptor.REPORTS.get(data[1]) \
+            if len(data) > 1 else None
+        if definition is None:
+            self._handshake(HIDP_INVALID_REPORT_ID)
+            return
+        if report_type == HIDP_INPUT:
+            reply = self._input_report(definition)
+        elif report_type == HIDP_OUTPUT and definition.output is not None:
+            reply = definition.output.pack(hid_descriptor.DATA_OUTPUT,
+                                           definition.report_id, self.leds)
+        elif report_type == HIDP_FEATURE and definition.feature is not None:
+            reply = definition.pack_feature(self.multipliers)
+        else:
+            self._handshake(HIDP_INVALID_REPORT_ID)
+            return
+        if data[0] & HIDP_GET_REPORT_SIZE and len(data) >= 4:
+            # the size does not count the DATA header
+            reply = reply[:1 + int.from_bytes(data[2:4], 'little')]
+        self._reply(reply)
+
+    def _input_report(self, definition):
+        """
+        :return: (bytes) the last report sent of a report ID, with no
+        movement as that has been reported already
+        """
+        report = self.last_reports.get(definition.report_id)
+        if report is None or definition.relative is not None:
+            report = bytes(definition.buffer())
+        elif type(report) is bytearray:
+            # the kept buffer changes with the next report
+            report = bytes(report)
+        if self.protocol == BOOT_PROTOCOL:
+            report = hid_descriptor.boot_report(report) or report
+        return report
+
+    def _set_report(self, data):
+        report_type = data[0] & 0x03
+        if report_type == HIDP_OUTPUT:
+            self._handshake(HIDP_SUCCESSFUL if self._output(data)
+                            else HIDP_INVALID_REPORT_ID)
+            return
+        if report_type != HIDP_FEATURE:
+            self._handshake(HIDP_UNSUPPORTED_REQUEST)
+            return
+        if data[1:2] != bytes([HIRES_MOUSE_REPORT]):
+            self._handshake(HIDP_INVALID_REPORT_ID)
+            return
+        if len(data) != hid_descriptor.HIRES_MOUSE.feature.size:
+            self._handshake(HIDP_INVALID_PARAMETER)
+            return
+        self.multipliers = data[2]
+        logger.info('{} set the wheel resolution multipliers to {:#x}'.format(
+            self.address, self.multipliers))
+        self._handshake(HIDP_SUCCESSFUL)
+
+    def _output(self, data):
+        """
+        Take the keyboard LEDs from an output report, sent with SET_REPORT
+        or as DATA on the interrupt channel
+        :return: False if it is not the output report of the keyboard
+        """
+        # the boot keyboard output report is the same, report ID included
+        if len(data) != hid_descriptor.KEYBOARD.output.size \
+                or data[1] != KEYBOARD_REPORT:
+            return False
+        leds = hid_descriptor.KEYBOARD.unpack_output(data)[0]
+        if leds != self.leds:
+            self.leds = leds
+            self.device.on_leds(self, leds)
+        return True
+
+    def _set_idle(self, rate):
+        """
+        :param rate: repeat the keyboard report after rate * 4 ms without
+        a change, 0 to only send changes
+        """
+        self.idle_rate = rate
+        if self.idle_id is not None:
+            GLib.source_remove(self.idle_id)
+            self.idle_id = None
+        if rate:
+            self.idle_id = GLib.timeout_add(rate * IDLE_RATE_UNIT,
+                                            self._idle)
+
+    def _idle(self):
+        """
+        Send the last keyboard report again once nothing has been sent
+        for the idle period
+        """
+        period = self.idle_rate * IDLE_RATE_UNIT / 1000
+        wait = self.last_time + period - time.monotonic()
+        if wait <= 0:
+            if self.last_id is not None and self.write_watch is None \
+                    and not self.queue:
+                self._write(self.last_reports[self.last_id])
+            wait = period
+        self.idle_id = GLib.timeout_add(max(1, int(wait * 1000)), self._idle)
+        return False
+
+    def _handshake(self, result):
+        self._reply(bytes([HIDP_HANDSHAKE << 4 | result]))
+
+    def _reply(self, data):
+        try:
+            self.ccontrol.send(data)
+        except OSError as ex:
+            logger.warning('Reply to {} failed: {}'.format(self.address, ex))
+
+    def _scale_wheels(self, msg):
+        """
+        Turn the high resolution wheel counts of a report into detents
+        for a host that has not turned the Resolution Multiplier on
+        """
+        values = list(hid_descriptor.HIRES_MOUSE.unpack(msg))
+        for index, shift in enumerate(WHEEL_MULTIPLIER_SHIFTS):
+            if (self.multipliers >> shift) & 0x03:
+                continue
+            counts = self.wheel_rest[index] + values[3 + index]
+            detents = int(counts / hid_descriptor.WHEEL_RESOLUTION)
+            self.wheel_rest[index] = \
+                counts - detents * hid_descriptor.WHEEL_RESOLUTION
+            values[3 + index] = detents
+        scaled = hid_descriptor.HIRES_MOUSE.pack(*values)
+        if type(msg) is TracedReport:
+            scaled = TracedReport(scaled, msg.trace)
+        return scaled
+
+    def send(self, msg):
+        """
+        Send a HID message to this host, or queue it if the host is busy
+        :param msg: (bytes-like) HID packet to send, a memoryview is only
+        copied when the report has to wait
+        """
+        if msg[1] == HIRES_MOUSE_REPORT and self.multipliers != HIRES_WHEELS:
+            msg = self._scale_wheels(msg)
+        if self.report_state is not None \
+                and not self.report_state.changed(msg):
+            self.counters['suppressed'] += 1
+            return
+        if self.write_watch is None and not self.queue \
+                and self._write(msg):
+            # nothing was waiting, written straight from the caller's buffer
+            return
+        # the caller may reuse its buffer, a waiting report is a copy
+        self.queue.push(bytes(msg) if type(msg) is memoryview else msg)
+        self._wait_writable()
+
+    def _write(self, msg):
+        """
+        Write one report to the interrupt channel
+        :return: False if the channel is full and msg has to wait
+        """
+        traced = type(msg) is TracedReport
+        if traced:
+            send_start = time.time()
+        data = msg
+        if self.protocol == BOOT_PROTOCOL:
+            data = hid_descriptor.boot_report(msg)
+            if data is None:
+                return True
+        try:
+            self.cinterrupt.send(data)
+        except BlockingIOError:
+            return False
+        except OSError as ex:
+            logger.warning('Send to {} failed: {}'.format(self.address, ex))
+            self.device.on_disconnect(self)
+            return True
+        self.counters['sent'] += 1
+        if msg[1] not in RELATIVE_REPORTS:
+            self.last_id = msg[1]
+            self._keep(msg)
+            self.last_time = time.monotonic()
+        if self.since is not None:
+            self.device.connect_times['first_report'].add(
+                time.monotonic() - self.since)
+            self.since = None
+        if traced and self.device.tracer is not None:
+            self.device.tracer.record(msg.trace, send_start, time.time())
+        return True
+
+    def _keep(self, msg):
+        """
+        Keep the last report of its report ID for GET_REPORT and the idle
+        rate. Bytes are kept as they are, the caller may reuse the buffer
+        of a memoryview and a traced report is sent once, they are copied
+        into a buffer kept for the report ID
+        """
+        if type(msg) is bytes:
+            self.last_reports[msg[1]] = msg
+            return
+        kept = self.last_reports.get(msg[1])
+        if type(kept) is bytearray and len(kept) == len(msg):
+            if kept is not msg:
+                kept[:] = msg
+        else:
+            self.last_reports[msg[1]] = bytearray(msg)
+
+    def _wait_writable(self):
+        # L2CAP buffer is full, carry on when it is writable
+        if self.write_watch is None:
+            self.write_watch = GLib.io_add_watch(
+                self.cinterrupt.fileno(), GLib.PRIORITY_HIGH,
+                GLib.IO_OUT, self._flush)
+
+    def _flush(self, fd=None, condition=None):
+        """
+        Send everything that is waiting in one go
+        """
+        while self.queue:
+            if not self._write(self.queue.peek()):
+                self._wait_writable()
+                return True
+            if not self.connected:
+                # the send failed and the host is gone
+                return False
+            self.queue.pop()
+        self.write_watch = None
+        return False
+
+    def close(self):
+        for watch in self.watches:
+            GLib.source_remove(watch)
+        self.watches = []
+        for source in (self.write_watch, self.reconnect_id, self.idle_id):
+            if source is not None:
+                GLib.source_remove(source)
+        self.write_watch = None
+        self.reconnect_id = None
+        self.idle_id = None
+        for sock in (self.ccontrol, self.cinterrupt, self.connecting):
+            if sock is not None:
+                sock.close()
+        self.ccontrol = None
+        self.cinterrupt = None
+        self.connecting = None
+        self.queue.clear()
+
+    def connect(self):
+        """
+        Connect to the host. Failed attempts are retried from the
+        main loop with an exponential backoff
+        """
+        self.reconnect_id = None
+        if self.connected:
+            return False
+        logger.info("Trying reconnect to {}...".format(self.address))
+        self._connect_socket(self.device.P_CTRL, self._control_connected)
+        return False
+
+    def _connect_socket(self, port, on_connected):
+        sock = socket.socket(socket.AF_BLUETOOTH,
+                             socket.SOCK_SEQPACKET,
+                             socket.BTPROTO_L2CAP)
+        sock.setblocking(False)
+        err = sock.connect_ex((self.address, port))
+        if err not in (0, errno.EINPROGRESS):
+            sock.close()
+            self._retry(os.strerror(err))
+            return
+        self.connecting = sock
+        self.reconnect_id = GLib.io_add_watch(
+            sock.fileno(), GLib.PRIORITY_DEFAULT,
+            GLib.IO_OUT | GLib.IO_HUP | GLib.IO_ERR,
+            self._connect_done, sock, on_connected)
+
+    def _connect_done(self, fd, condition, sock, on_connected):
+        self.reconnect_id = None
+        self.connecting = None
+        err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            sock.close()
+            self._retry(os.strerror(err))
+            return False
+        on_connected(sock)
+        return False
+
+    def _control_connected(self, sock):
+        sock.setblocking(True)
+        self.ccontrol = sock
+        self._connect_socket(self.device.P_INTR, self._interrupt_connected)
+
+    def _interrupt_connected(self, sock):
+        self.attach_interrupt(sock)
+        self._watch(self.ccontrol, GLib.PRIORITY_HIGH)
+        self.reconnect_delay = self.RECONNECT_MIN_DELAY
+        self.reconnect_attempts = 0
+        logger.info("Connected to {}!".format(self.address))
+
+    def _retry(self, reason):
+        if self.ccontrol is not None:
+            self.ccontrol.close()
+            self.ccontrol = None
+        self.reconnect_attempts += 1
+        if self.reconnect_attempts >= self.RECONNECT_MAX_ATTEMPTS:
+            logger.warning("Giving up reconnecting to {}: {}".format(
+                self.address, reason))
+            self.device.on_disconnect(self, reconnect=False)
+            return
+        logger.warning("didnt connect, will retry in {}s... {}".format(
+            self.reconnect_delay, reason))
+        self.reconnect_id = GLib.timeout_add(
+            int(self.reconnect_delay * 1000), self.connect)
+        self.reconnect_delay = min(self.reconnect_delay * 2,
+                                   self.RECONNECT_MAX_DELAY)
+
+
 class BTKbDevice:
     """
     create a bluetooth device to emulate a HID keyboard
@@ -76,14 +769,48 @@ class BTKbDevice:
     # UUID for HID service (1124)
     # https://www.bluetooth.com/specifications/assigned-numbers/service-discovery
     UUID = '00001124-0000-1000-8000-00805f9b34fb'
+    # Hosts that can be connected at the same time
+    MAX_HOSTS = 7
+    # The profile is registered once for all adapters
+    profile = None
 
     def __init__(self, hci=0):
         self.scontrol = None
-        self.ccontrol = None  # Socket object for control
         self.sinterrupt = None
-        self.cinterrupt = None  # Socket object for interrupt
+        self.connections = {}  # HostConnection by host address
+        # counters of the hosts that are no longer connected
+        self.counters = collections.Counter()
+        # latency histograms, set by the service when tracing
+        self.tracer = None
+        # drop reports equal to the last one sent to a host, set by the
+        # service
+        self.dedup = False
+        # recently connected hosts, set by the service to connect back to
+        # them on startup and when a link is lost
+        self.known_hosts = None
+        # connect times by CONNECT_STAGES, shared by the service
+        self.connect_times = {stage: LatencyHistogram()
+                              for stage in CONNECT_STAGES}
+        # function called with the host address and the LED bits when a
+        # host sets its keyboard LEDs, set by the service
+        self.leds_changed = None
+        # optional TickScheduler the reports go through, set by the
+        # service
+        self.scheduler = None
+        # address of the only host the reports go to, None for all hosts,
+        # set by the service
+        self.active = None
+        # function called with the address of the active host when it
+        # disconnects, set by the service
+        self.active_lost = None
         self.dev_path = '/org/bluez/hci{}'.format(hci)
-        print('Setting up BT device')
+        self.setup_adapter()
+
+    def setup_adapter(self):
+        """
+        Configure the BlueZ adapter and register the HID profile
+        """
+        logger.info('Setting up BT device')
         self.bus = dbus.SystemBus()
         self.adapter_methods = dbus.Interface(
             self.bus.get_object('org.bluez',
@@ -104,7 +831,7 @@ class BTKbDevice:
                                      arg0=self.DEVICE_INTERFACE,
                                      path_keyword='path')
 
-        print('Configuring for name {}'.format(BTKbDevice.MY_DEV_NAME))
+        logger.info('Configuring for name {}'.format(BTKbDevice.MY_DEV_NAME))
 
         self.config_hid_profile()
 
@@ -117,14 +844,43 @@ class BTKbDevice:
         pass
 
     def _properties_changed(self, interface, changed, invalidated, path):
-        if self.on_disconnect is not None:
-            if 'Connected' in changed:
-                if not changed['Connected']:
-                    self.on_disconnect()
+        if 'Connected' in changed and not changed['Connected']:
+            for connection in list(self.connections.values()):
+                device_path = '{}/dev_{}'.format(
+                    self.dev_path, connection.address.replace(':', '_'))
+                # a connection being set up has not lost anything
+                if path == device_path and connection.connected:
+                    self.on_disconnect(connection)
 
-    def on_disconnect(self):
-        print('The client has been disconnect')
-        self.listen()
+    def on_connect(self, connection):
+        self.connect_times['connect'].add(time.monotonic() - connection.since)
+        if self.known_hosts is not None:
+            self.known_hosts.add(self.address, connection.address)
+
+    def on_leds(self, connection, leds):
+        logger.info('{} set the keyboard LEDs to {:#04x}'.format(
+            connection.address, leds))
+        if self.leds_changed is not None:
+            self.leds_changed(connection.address, leds)
+
+    def on_disconnect(self, connection, reconnect=True):
+        """
+        Forget a host whose link is gone
+        :param reconnect: connect back to it if it is a known host
+        """
+        if self.connections.get(connection.address) is not connection:
+            return
+        logger.info('{} has been disconnected'.format(connection.address))
+        # the server sockets are still listening for the next host
+        del self.connections[connection.address]
+        lost = connection.connected
+        connection.close()
+        self.counters.update(connection.counters)
+        if connection.address == self.active \
+                and self.active_lost is not None:
+            self.active_lost(connection.address)
+        if reconnect and lost and self.known_hosts is not None:
+            self.reconnect(connection.address)
 
     @property
     def address(self):
@@ -183,7 +939,7 @@ class BTKbDevice:
         Setup and register HID Profile
         """
 
-        print('Configuring Bluez Profile')
+        logger.info('Configuring Bluez Profile')
         service_record = self.read_sdp_service_record()
 
         opts = {
@@ -198,82 +954,444 @@ class BTKbDevice:
                                                      '/org/bluez'),
                                  'org.bluez.ProfileManager1')
 
-        HumanInterfaceDeviceProfile(self.bus,
-                                    BTKbDevice.PROFILE_DBUS_PATH)
+        if BTKbDevice.profile is not None:
+            logger.info('Profile already registered')
+            return
+
+        BTKbDevice.profile = HumanInterfaceDeviceProfile(
+            self.bus, BTKbDevice.PROFILE_DBUS_PATH)
 
         manager.RegisterProfile(BTKbDevice.PROFILE_DBUS_PATH,
                                 BTKbDevice.UUID,
                                 opts)
 
-        print('Profile registered ')
+        logger.info('Profile registered ')
 
     @staticmethod
     def read_sdp_service_record():
         """
-        Read and return SDP record from a file
+        Read the SDP record from a file and put the report descriptor
+        compiled by hid_descriptor in it
         :return: (string) SDP record
         """
-        print('Reading service record')
+        logger.info('Reading service record')
         try:
             fh = open(BTKbDevice.SDP_RECORD_PATH, 'r')
         except OSError:
             sys.exit('Could not open the sdp record. Exiting...')
 
-        return fh.read()
+        with fh:
+            return hid_descriptor.sdp_record(fh.read())
 
     def listen(self):
         """
-        Listen for connections coming from HID client
+        Listen for connections coming from HID client.
+        Returns straight away, connections are accepted from the main loop
         """
 
-        print('Waiting for connections')
-        self.scontrol = socket.socket(socket.AF_BLUETOOTH,
-                                      socket.SOCK_SEQPACKET,
-                                      socket.BTPROTO_L2CAP)
-        self.scontrol.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.sinterrupt = socket.socket(socket.AF_BLUETOOTH,
-                                        socket.SOCK_SEQPACKET,
-                                        socket.BTPROTO_L2CAP)
-        self.sinterrupt.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.scontrol.bind((self.address, self.P_CTRL))
-        self.sinterrupt.bind((self.address, self.P_INTR))
+        logger.info('Waiting for connections')
+        self.scontrol = self._server_socket(self.P_CTRL)
+        self.sinterrupt = self._server_socket(self.P_INTR)
+
+        GLib.io_add_watch(self.scontrol.fileno(), GLib.PRIORITY_DEFAULT,
+                          GLib.IO_IN, self._accept_control)
+        GLib.io_add_watch(self.sinterrupt.fileno(), GLib.PRIORITY_DEFAULT,
+                          GLib.IO_IN, self._accept_interrupt)
+
+    def _server_socket(self, port):
+        sock = socket.socket(socket.AF_BLUETOOTH,
+                             socket.SOCK_SEQPACKET,
+                             socket.BTPROTO_L2CAP)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setblocking(False)
+        sock.bind((self.address, port))
+        # Start listening on the server socket
+        sock.listen(self.MAX_HOSTS)
+        return sock
+
+    def _accept_control(self, fd, condition):
+        try:
+            ccontrol, cinfo = self.scontrol.accept()
+        except BlockingIOError:
+            return True
+        logger.info('{} connected on the control socket'.format(cinfo[0]))
+        # replaces an old or pending outgoing connection to the same host
+        old = self.connections.pop(cinfo[0], None)
+        if old is not None:
+            old.close()
+        connection = HostConnection(self, cinfo[0])
+        connection.attach_control(ccontrol)
+        self.connections[cinfo[0]] = connection
+        return True
+
+    def _accept_interrupt(self, fd, condition):
+        try:
+            cinterrupt, cinfo = self.sinterrupt.accept()
+        except BlockingIOError:
+            return True
+        connection = self.connections.get(cinfo[0])
+        if connection is None or connection.ccontrol is None \
+                or connection.connected:
+            logger.warning('{} opened the interrupt channel without a '
+                           'control channel, rejecting'.format(cinfo[0]))
+            cinterrupt.close()
+            return True
+        logger.info('{} connected on the interrupt channel'.format(cinfo[0]))
+        connection.attach_interrupt(cinterrupt)
+        return True
 
-        # Start listening on the server sockets
-        self.scontrol.listen(1)  # Limit of 1 connection
-        self.sinterrupt.listen(1)
+    @property
+    def connected(self):
+        return any(connection.connected
+                   for connection in self.connections.values())
 
-        self.ccontrol, cinfo = self.scontrol.accept()
-        print('{} connected on the control socket'.format(cinfo[0]))
+    def can_send(self, msg):
+        """
+        :return: False if a host would have to refuse msg
+        """
+        if self.scheduler is not None and self.scheduler.full(msg):
+            return False
+        return not any(connection.queue.full(msg)
+                       for connection in self.targets())
 
-        self.cinterrupt, cinfo = self.sinterrupt.accept()
-        print('{} connected on the interrupt channel'.format(cinfo[0]))
+    def targets(self):
+        """
+        :return: list of the connected hosts the reports go to
+        """
+        if self.active is not None:
+            connection = self.connections.get(self.active)
+            if connection is None or not connection.connected:
+                return []
+            return [connection]
+        return [connection for connection in self.connections.values()
+                if connection.connected]
 
     def send(self, msg):
         """
-        Send HID message
-        :param msg: (bytes) HID packet to send
+        Send HID message to the connected hosts, on the next tick when
+        there is a scheduler
+        :param msg: (bytes-like) HID packet to send, it is not copied
+        unless a host has to queue it
         """
-        print(msg)
-        print(self.cinterrupt.send(bytes(bytearray(msg))))
-        
+        if self.scheduler is not None:
+            self.scheduler.submit(msg)
+            return
+        self.send_now(msg)
+
+    def send_now(self, msg):
+        """
+        Send HID message to the connected hosts at once
+        :param msg: (bytes-like) HID packet to send
+        """
+        for connection in self.targets():
+            connection.send(msg)
+
+    def get_counters(self):
+        """
+        :return: (Counter) send counters summed over all hosts
+        """
+        counters = collections.Counter(self.counters)
+        for connection in self.connections.values():
+            counters.update(connection.counters)
+        return counters
+
+    def reconnect_known(self):
+        """
+        Connect to the hosts that were connected most recently, instead of
+        waiting for them to connect
+        """
+        for host in self.known_hosts.get(self.address):
+            self.reconnect(host)
 
     def reconnect(self, hidHost):
-        print("Trying reconnect...")
+        """
+        Connect to a known host. Failed attempts are retried from the
+        main loop with an exponential backoff
+        :param hidHost: address of the host, 'XX:XX:XX:XX:XX:XX'
+        """
+        if hidHost in self.connections:
+            return
+        connection = HostConnection(self, hidHost)
+        self.connections[hidHost] = connection
+        connection.connect()
+
+
+class ReportSocketServer:
+    """
+    Accept local clients on a SOCK_SEQPACKET Unix socket and forward
+    every packet they write to the Bluetooth hosts.
+    This is a lower latency alternative to the send_keys/send_mouse
+    D-Bus methods, D-Bus is still used for everything else.
+    When a host is too far behind, a client is not read until the report
+    it sent has gone out, its next reports wait in the socket and its
+    writes block, so no report is lost.
+    """
+    # seconds to wait when the hosts do not take a report
+    RETRY_DELAY = 0.01
+
+    def __init__(self, service, path=REPORT_SOCKET_PATH):
+        self.service = service
+        self.path = path
+        self.clients = {}
+        # (report, trace) refused by the service, by client fd
+        self.held = {}
+        # every packet is received into the same buffer and passed on as
+        # a memoryview slice, see HostConnection.send
+        self.buffer = bytearray(MAX_REPORT_SIZE)
+        self.view = memoryview(self.buffer)
+
+        # remove a socket left behind by a previous run
+        if os.path.exists(path):
+            os.unlink(path)
+
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.server.setblocking(False)
+        self.server.bind(path)
+        # same open policy as org.yaptb.btkbservice.conf
+        os.chmod(path, 0o666)
+        self.server.listen(8)
+
+        GLib.io_add_watch(self.server.fileno(), GLib.PRIORITY_DEFAULT,
+                          GLib.IO_IN, self._accept)
+        logger.info('Listening for reports on {}'.format(path))
+
+    def _accept(self, fd, condition):
+        try:
+            client, _ = self.server.accept()
+        except BlockingIOError:
+            return True
+        client.setblocking(False)
+        self.clients[client.fileno()] = client
+        self._watch(client.fileno())
+        return True
+
+    def _watch(self, fd):
+        GLib.io_add_watch(fd, GLib.PRIORITY_HIGH,
+                          GLib.IO_IN | GLib.IO_HUP | GLib.IO_ERR,
+                          self._read)
+
+    def _read(self, fd, condition):
+        client = self.clients[fd]
+        # drain everything that is queued before going back to the loop
         while True:
             try:
-                # hidHost = 'XX:XX:XX:XX:XX:XX'
-                self.ccontrol = socket.socket(socket.AF_BLUETOOTH,
-                                              socket.SOCK_SEQPACKET,
-                                              socket.BTPROTO_L2CAP)
-                self.cinterrupt = socket.socket(socket.AF_BLUETOOTH,
-                                                socket.SOCK_SEQPACKET,
-                                                socket.BTPROTO_L2CAP)
-                self.ccontrol.connect((hidHost, self.P_CTRL))
-                self.cinterrupt.connect((hidHost, self.P_INTR))
-                print("Connected!")
-            except Exception as ex:
-                print("didnt connect, will retry..." + str(ex))
-                time.sleep(1)
+                size = client.recv_into(self.buffer)
+            except BlockingIOError:
+                return True
+            except OSError:
+                size = 0
+            if not size:
+                del self.clients[fd]
+                client.close()
+                return False
+            report = self.view[:size]
+            trace = None
+            if report[0] == TRACE_MAGIC:
+                if size < TRACE_HEADER.size + 2:
+                    continue
+                _, event_time, client_time = TRACE_HEADER.unpack_from(
+                    self.buffer)
+                report = bytes(report[TRACE_HEADER.size:])
+                trace = (event_time, client_time)
+            if not self._send(report, trace):
+                # hold the report, the ones after it stay in the socket
+                logger.warning('A host is behind, holding the reports of '
+                               'a report socket client')
+                self.held[fd] = (bytes(report), trace)
+                GLib.timeout_add(int(self.RETRY_DELAY * 1000), self._retry,
+                                 fd)
+                return False
+
+    def _send(self, report, trace):
+        """
+        :return: False if a host is too far behind to take the report
+        """
+        try:
+            if trace is None:
+                return self.service.send(report)
+            return self.service.send_with_trace(report, *trace)
+        except ValueError:
+            # not a report of the descriptor, there is nobody to tell
+            return True
+
+    def _retry(self, fd):
+        """
+        Send a held report again and read the client once it went out
+        """
+        if fd not in self.clients:
+            self.held.pop(fd, None)
+            return False
+        if not self._send(*self.held[fd]):
+            return True
+        del self.held[fd]
+        self._watch(fd)
+        return False
+
+    def close(self):
+        for client in self.clients.values():
+            client.close()
+        self.clients.clear()
+        self.held.clear()
+        self.server.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class ReportPacer:
+    """
+    Queue of reports that are paced onto the hosts from the GLib
+    main loop. Deadlines are kept on the monotonic clock and advanced
+    by the requested delay, so a long sequence does not drift.
+    """
+    # seconds to wait when the hosts do not take a report
+    RETRY_DELAY = 0.01
+
+    def __init__(self, service):
+        self.service = service
+        self.queue = collections.deque()
+        self.deadline = 0.0
+        self.timeout_id = None
+
+    def submit(self, reports, done=None):
+        """
+        Queue reports for sending
+        :param reports: iterable of (report, delay) pairs, delay is the
+        time in microseconds to wait after the report before the next one
+        :param done: optional function called with True once the last
+        report has been sent, or with False if it was cancelled
+        """
+        entries = [(report, delay, None) for report, delay in reports]
+        if not entries:
+            if done is not None:
+                done(True)
+            return
+        if done is not None:
+            report, delay, _ = entries[-1]
+            entries[-1] = (report, delay, done)
+        self.queue.extend(entries)
+        if self.timeout_id is None:
+            self.deadline = max(self.deadline, time.monotonic())
+            self._run()
+
+    def clear(self):
+        cancelled = [done for _, _, done in self.queue if done is not None]
+        self.queue.clear()
+        if self.timeout_id is not None:
+            GLib.source_remove(self.timeout_id)
+            self.timeout_id = None
+        for done in cancelled:
+            done(False)
+
+    def _run(self):
+        self.timeout_id = None
+        now = time.monotonic()
+        while self.queue and self.deadline <= now:
+            report, delay, done = self.queue[0]
+            if not self.service.send(report):
+                # a host is behind, keep the order and try again shortly
+                self.deadline = now + self.RETRY_DELAY
+                break
+            self.queue.popleft()
+            self.deadline += delay / 1000000
+            if done is not None:
+                done(True)
+            now = time.monotonic()
+        if self.queue:
+            wait = math.ceil((self.deadline - now) * 1000)
+            self.timeout_id = GLib.timeout_add(wait, self._run)
+        return False
+
+
+class TickScheduler:
+    """
+    Fixed rate sending, the way a USB or Bluetooth HID device reports on
+    each poll. Reports update the pending state of their report ID and
+    every tick at most one report of each report ID goes to the hosts,
+    so the air time used is bounded whatever the clients send.
+    Mouse motion is added up until the next tick, a button change starts
+    a new state after it. Reports of the other IDs are key changes, they
+    are sent in order one per tick so no key press is lost.
+    :param send: function sending a report to the hosts
+    :param interval: milliseconds between ticks
+    """
+
+    def __init__(self, send, interval):
+        self.send = send
+        self.interval = interval
+        # waiting states by report ID: reports, or [bytes before the
+        # movement, bytes after it, movement] of the relative reports
+        self.pending = collections.defaultdict(collections.deque)
+        self.tick_id = None
+
+    def full(self, msg):
+        """
+        :return: True if msg has to be refused to keep the state bounded
+        """
+        return msg[1] not in RELATIVE_REPORTS \
+            and len(self.pending[msg[1]]) >= SendQueue.ORDERED_LIMIT
+
+    def submit(self, msg):
+        """
+        :param msg: (bytes-like) HID report, copied if it is a memoryview
+        """
+        pending = self.pending[msg[1]]
+        relative = RELATIVE_REPORTS.get(msg[1])
+        if relative is None:
+            pending.append(bytes(msg) if type(msg) is memoryview else msg)
+        else:
+            definition = hid_descriptor.REPORTS[msg[1]]
+            moves = definition.relative_struct.unpack(msg[relative])
+            head = bytes(msg[:relative.start])
+            tail = bytes(msg[relative.stop:])
+            if pending and pending[-1][0] == head and pending[-1][1] == tail:
+                state = pending[-1][2]
+                for index, move in enumerate(moves):
+                    state[index] += move
+            else:
+                pending.append([head, tail, list(moves)])
+        if self.tick_id is None:
+            # idle for at least a tick, the report goes out now
+            self._send_tick()
+            self.tick_id = GLib.timeout_add(self.interval, self._tick)
+
+    def clear(self):
+        self.pending.clear()
+        if self.tick_id is not None:
+            GLib.source_remove(self.tick_id)
+            self.tick_id = None
+
+    def _tick(self):
+        if not self._send_tick():
+            self.tick_id = None
+            return False
+        return True
+
+    def _send_tick(self):
+        """
+        Send the oldest state of every report ID
+        :return: False if there was nothing to send
+        """
+        sent = False
+        for report_id, pending in self.pending.items():
+            if not pending:
+                continue
+            sent = True
+            if report_id not in RELATIVE_REPORTS:
+                self.send(pending.popleft())
+                continue
+            definition = hid_descriptor.REPORTS[report_id]
+            head, tail, moves = pending[0]
+            steps = [max(low, min(high, move)) for move, (low, high)
+                     in zip(moves, definition.relative_limits)]
+            # what does not fit in one report waits for the next tick
+            rest = [move - step for move, step in zip(moves, steps)]
+            if any(rest):
+                pending[0][2] = rest
+            else:
+                pending.popleft()
+            self.send(head + definition.relative_struct.pack(*steps) + tail)
+        return sent
+
 
 class BTKbService(dbus.service.Object):
     """
@@ -281,42 +1399,414 @@ class BTKbService(dbus.service.Object):
     processes.
     Send the recieved HID messages to the Bluetooth HID server to send
     """
-    def __init__(self):
-        print('Setting up service')
+    # default reports per second of type_text
+    TYPE_RATE = 125
+    def __init__(self, hcis=(0,), stats_interval=60, ring_size=0,
+                 trace=False, dedup=False, bus=None, devices=None,
+                 report_socket_path=REPORT_SOCKET_PATH, known_hosts=None,
+                 tick=0):
+        logger.info('Setting up service')
 
         bus_name = dbus.service.BusName('org.yaptb.btkbservice',
-                                        bus=dbus.SystemBus())
+                                        bus=bus or dbus.SystemBus())
         dbus.service.Object.__init__(self, bus_name, '/org/yaptb/btkbservice')
 
-        # create and setup our device
-        self.device = BTKbDevice()
+        # create and setup a device for every adapter
+        if devices is None:
+            devices = [BTKbDevice(hci) for hci in hcis]
+        self.devices = devices
+
+        # latency histograms of traced reports
+        self.tracer = LatencyTracer() if trace else None
+        # connect times of the hosts of all adapters
+        self.connect_times = {stage: LatencyHistogram()
+                              for stage in CONNECT_STAGES}
+        # keyboard LEDs as set by the host that set them last
+        self.leds = 0
+        # the only host reports are sent to, None for all hosts
+        self.active_host = None
+        for device in self.devices:
+            device.tracer = self.tracer
+            device.leds_changed = self._leds_changed
+            device.active_lost = self._active_lost
+            if tick:
+                device.scheduler = TickScheduler(device.send_now, tick)
+            device.dedup = dedup
+            device.known_hosts = known_hosts
+            device.connect_times = self.connect_times
+
+        # start listening for socket connections, they are accepted
+        # from the main loop
+        for device in self.devices:
+            device.listen()
+
+        # connect back to the last hosts rather than wait for them
+        if known_hosts is not None:
+            for device in self.devices:
+                device.reconnect_known()
+
+        # local fast path for raw reports
+        self.report_socket = ReportSocketServer(self, report_socket_path)
+
+        # paced sending of batched reports
+        self.pacer = ReportPacer(self)
+
+        # reports refused because a host queue was full
+        self.rejected = 0
+        # reports that do not match the report descriptor
+        self.invalid = 0
+
+        # profiles started over D-Bus, timing the hot path while they run
+        self.profiler = Profiler(HotPathTimers({
+            'send_keys': (BTKbService, 'send_keys'),
+            'send_mouse': (BTKbService, 'send_mouse'),
+            'service_send': (BTKbService, 'send'),
+            'device_send': (BTKbDevice, 'send'),
+        }))
+
+        # optional in memory copy of the most recent reports
+        self.ring = collections.deque(maxlen=ring_size) if ring_size else None
+
+        # send counters are logged together instead of per report
+        if stats_interval:
+            GLib.timeout_add_seconds(stats_interval, self._log_counters)
 
-        # start listening for socket connections
-        self.device.listen()
+    def send(self, report):
+        """
+        Send a HID report to the hosts connected on all adapters
+        :param report: (bytes) HID packet to send
+        :return: False if a host is too far behind and the report was
+        not sent to any of them
+        :raise ValueError: if the report is not in the report descriptor
+        """
+        try:
+            hid_descriptor.check(report)
+        except ValueError:
+            self.invalid += 1
+            raise
+        if not all(device.can_send(report) for device in self.devices):
+            self.rejected += 1
+            return False
+        for device in self.devices:
+            device.send(report)
+        if self.ring is not None:
+            self.ring.append((time.time(), bytes(report)))
+        return True
+
+    def send_with_trace(self, report, event_time, client_time):
+        """
+        Send a HID report that carries the time of its input event
+        :param report: (bytes) HID packet to send
+        :param event_time: evdev timestamp of the input event
+        :param client_time: time the client sent the report
+        """
+        if self.tracer is not None:
+            report = TracedReport(report, (event_time, client_time,
+                                           time.time()))
+        return self.send(report)
+
+    def _log_counters(self):
+        for device in self.devices:
+            for connection in device.connections.values():
+                delta = connection.counters - connection.logged
+                if not delta:
+                    continue
+                connection.logged = collections.Counter(connection.counters)
+                logger.info('{}: {} queued {}'.format(
+                    connection.address,
+                    ' '.join('{} {}'.format(name, value)
+                             for name, value in sorted(delta.items())),
+                    len(connection.queue)))
+        return True
     
-    @dbus.service.method('org.yaptb.btkbservice',
-                        in_signature='ay')
+    @dbus.service.method('org.yaptb.btkbservice', in_signature='ay',
+                         byte_arrays=True)
     def send_keys(self, keys):
-        self.device.send(keys)
+        try:
+            sent = self.send(keys)
+        except ValueError as ex:
+            raise InvalidArgsError(str(ex))
+        if not sent:
+            raise BusyError('Host queue is full, try again later')
     
     
-    @dbus.service.method('org.yaptb.btkbservice',in_signature='ai')
+    @dbus.service.method('org.yaptb.btkbservice', in_signature='aydd',
+                         byte_arrays=True)
+    def send_traced(self, report, event_time, client_time):
+        """
+        send_keys/send_mouse for a report that carries the evdev
+        timestamp of its input event and the time the client sent it
+        """
+        try:
+            sent = self.send_with_trace(report, event_time, client_time)
+        except ValueError as ex:
+            raise InvalidArgsError(str(ex))
+        if not sent:
+            raise BusyError('Host queue is full, try again later')
+
+    @dbus.service.method('org.yaptb.btkbservice', in_signature='ay',
+                         byte_arrays=True)
     def send_mouse(self, state):
-        print("Received Mouse Input, sending it via Bluetooth")
-        
-        self.device.send(state)
-        
+        try:
+            sent = self.send(state)
+        except ValueError as ex:
+            raise InvalidArgsError(str(ex))
+        if not sent:
+            raise BusyError('Host queue is full, try again later')
+
+    @dbus.service.method('org.yaptb.btkbservice', in_signature='a(ayu)',
+                         out_signature='u', byte_arrays=True)
+    def send_batch(self, reports):
+        """
+        Queue a sequence of reports to be sent at the given pace
+        :param reports: array of (report, delay in microseconds after it)
+        :return: number of reports waiting to be sent
+        """
+        batch = [(bytes(report), delay) for report, delay in reports]
+        try:
+            for report, _ in batch:
+                hid_descriptor.check(report)
+        except ValueError as ex:
+            raise InvalidArgsError(str(ex))
+        self.pacer.submit(batch)
+        return len(self.pacer.queue)
+
+    @dbus.service.method('org.yaptb.btkbservice', in_signature='ssu',
+                         out_signature='d', async_callbacks=('reply', 'error'))
+    def type_text(self, text, layout, rate, reply, error):
+        """
+        Type a text on the hosts. Returns when the last report is sent
+        :param text: text to type
+        :param layout: keyboard layout of the hosts, '' for us
+        :param rate: reports per second, 0 for TYPE_RATE
+        :return: characters typed per second
+        """
+        try:
+            reports = keymap.text_reports(text, layout or 'us')
+        except (KeyError, ValueError) as ex:
+            error(InvalidArgsError(str(ex)))
+            return
+        delay = 1000000 // (rate or self.TYPE_RATE)
+        start = time.monotonic()
+
+        def done(completed):
+            if not completed:
+                error(CancelledError('Typing was cancelled'))
+                return
+            elapsed = time.monotonic() - start
+            reply(len(text) / elapsed if elapsed > 0 else 0.0)
+
+        self.pacer.submit(((report, delay) for report in reports), done)
+
+    @dbus.service.method('org.yaptb.btkbservice', in_signature='')
+    def cancel_batch(self):
+        self.pacer.clear()
+
+    @dbus.service.method('org.yaptb.btkbservice', in_signature='',
+                         out_signature='a{st}')
+    def get_counters(self):
+        """
+        Counters of the send queues: reports sent, mouse reports merged,
+        mouse button states dropped with their motion kept, reports
+        rejected because a host was too far behind
+        and invalid reports
+        """
+        counters = collections.Counter(rejected=self.rejected,
+                                       invalid=self.invalid)
+        for device in self.devices:
+            counters.update(device.get_counters())
+        return {name: dbus.UInt64(value) for name, value in counters.items()}
+
+    @dbus.service.method('org.yaptb.btkbservice', in_signature='',
+                         out_signature='a(day)')
+    def dump_reports(self):
+        """
+        The most recent reports sent with the time they were sent.
+        Empty unless the service was started with --ring-size
+        """
+        if self.ring is None:
+            return dbus.Array([], signature='(day)')
+        return dbus.Array([(stamp, dbus.ByteArray(report))
+                           for stamp, report in self.ring],
+                          signature='(day)')
+
+    @dbus.service.method('org.yaptb.btkbservice', in_signature='',
+                         out_signature='a{sa{sd}}')
+    def GetStats(self):
+        """
+        Latency of traced reports per stage: client processing, ipc,
+        queue in the service, socket send and total, only when the
+        service was started with --trace. Time for hosts to connect and
+        to get their first report, once a host has connected. Time
+        spent in the hot path timers of the last profile
+        """
+        stats = self.tracer.summary() if self.tracer is not None else {}
+        for stage, histogram in self.connect_times.items():
+            if histogram.count:
+                stats[stage] = histogram.summary()
+        stats.update(self.profiler.timers.summary())
+        return dbus.Dictionary(stats, signature='sa{sd}')
+
+    @dbus.service.method('org.yaptb.btkbservice', in_signature='ss')
+    def start_profiler(self, mode, path):
+        """
+        Profile the service until stop_profiler, and time send_keys,
+        send_mouse and the sends of the service and the devices
+        :param mode: 'cprofile' for a pstats file, 'sampling' for
+        collapsed stacks, '' for cprofile
+        :param path: file to write the profile to, '' for the default
+        """
+        try:
+            self.profiler.start(str(mode) or CPROFILE, str(path) or None)
+        except ValueError as ex:
+            raise InvalidArgsError(str(ex))
+        except RuntimeError as ex:
+            raise BusyError(str(ex))
+        logger.info('Started the {} profiler'.format(self.profiler.mode))
+
+    @dbus.service.method('org.yaptb.btkbservice', in_signature='',
+                         out_signature='s')
+    def stop_profiler(self):
+        """
+        Stop the profile and write it
+        :return: file the profile was written to, '' if none was running
+        """
+        if not self.profiler.running:
+            return ''
+        try:
+            path = self.profiler.stop()
+        except OSError as ex:
+            raise dbus.DBusException('Could not write the profile: {}'.format(
+                ex))
+        logger.info('Profile written to {}'.format(path))
+        return path
+
+    def _leds_changed(self, address, leds):
+        self.leds = leds
+        self.LedsChanged(address, leds)
+
+    @dbus.service.signal('org.yaptb.btkbservice', signature='sy')
+    def LedsChanged(self, address, leds):
+        """
+        A host has set its keyboard LEDs
+        :param address: address of the host
+        :param leds: LED bits, see hid_descriptor.LED_NUM_LOCK and others
+        """
+
+    @dbus.service.method('org.yaptb.btkbservice', in_signature='',
+                         out_signature='y')
+    def get_leds(self):
+        """
+        Keyboard LEDs as set by the host that set them last
+        """
+        return dbus.Byte(self.leds)
+
+    def switch_host(self, address):
+        """
+        Send the reports to one host only, or to all hosts again. The
+        hosts that no longer get the reports have every key and button
+        released, batches being sent are cancelled
+        :param address: address of the host, None for all hosts
+        """
+        if address == self.active_host:
+            return
+        before = [connection for device in self.devices
+                  for connection in device.targets()]
+        self.pacer.clear()
+        for device in self.devices:
+            if device.scheduler is not None:
+                device.scheduler.clear()
+            device.active = address
+        after = [connection for device in self.devices
+                 for connection in device.targets()]
+        released = [connection for connection in before
+                    if connection not in after]
+        for connection in released:
+            for report in hid_descriptor.REPORTS.values():
+                connection.send(bytes(report.buffer()))
+        self.active_host = address
+        logger.info('Sending to {}'.format(address or 'all hosts'))
+        self.ActiveHostChanged(address or '')
+
+    def _active_lost(self, address):
+        # the host may still be connected on another adapter
+        if any(connection.address == address and connection.connected
+               for device in self.devices
+               for connection in device.connections.values()):
+            return
+        logger.warning('The active host {} is gone, sending to all '
+                       'hosts'.format(address))
+        self.switch_host(None)
+
+    @dbus.service.signal('org.yaptb.btkbservice', signature='s')
+    def ActiveHostChanged(self, address):
+        """
+        :param address: the only host reports are sent to, '' for all
+        """
+
+    @dbus.service.method('org.yaptb.btkbservice', in_signature='s')
+    def set_active_host(self, address):
+        """
+        KVM switch: send the reports to one of the connected hosts only,
+        the links to the others stay up
+        :param address: address of a connected host, '' for all hosts
+        """
+        address = str(address) or None
+        if address is not None and not any(
+                connection.address == address and connection.connected
+                for device in self.devices
+                for connection in device.connections.values()):
+            raise InvalidArgsError('{} is not connected'.format(address))
+        self.switch_host(address)
+
+    @dbus.service.method('org.yaptb.btkbservice', in_signature='',
+                         out_signature='s')
+    def get_active_host(self):
+        """
+        The only host reports are sent to, '' when they go to all hosts
+        """
+        return self.active_host or ''
+
+    @dbus.service.method('org.yaptb.btkbservice', in_signature='',
+                         out_signature='as')
+    def get_hosts(self):
+        """
+        Addresses of the connected hosts of all adapters, sorted so a
+        host keeps its place when it reconnects
+        """
+        hosts = {connection.address for device in self.devices
+                 for connection in device.connections.values()
+                 if connection.connected}
+        return dbus.Array(sorted(hosts), signature='s')
+
     @dbus.service.method('org.freedesktop.DBus.Introspectable', out_signature='s')
     def Introspect(self):
           return ET.tostring(ET.parse(os.getcwd()+'/org.yaptb.hidbluetooth.introspection').getroot(), encoding='utf8', method='xml')
 
 
+parser = argparse.ArgumentParser(
+    description="Bluetooth HID service forwarding reports from the D-Bus clients to the connected hosts")
+parser.add_argument('--log-level', default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], help="lowest level to log. Default is INFO")
+parser.add_argument('--stats-interval', default=60, type=int, help="seconds between logs of the per host send counters, 0 to disable. Default is 60")
+parser.add_argument('--ring-size', default=0, type=int, help="number of recent reports kept for dump_reports. Default is 0")
+parser.add_argument('--trace', action='store_true', help="record latency histograms of traced reports, see GetStats")
+parser.add_argument('--dedup', action='store_true', help="do not send a host a report equal to the last one it got")
+parser.add_argument('--tick', default=0, type=int, help="send at most one report per report ID every TICK milliseconds, adding up the mouse motion in between. Default is 0, every report at once")
+parser.add_argument('--hosts-file', default=KNOWN_HOSTS_PATH, type=str, help="file keeping the last connected hosts, connected to again on startup and when their link is lost. '' to only wait for hosts. Default is " + KNOWN_HOSTS_PATH)
+parser.add_argument('--hci', default=[0], type=int, nargs='+', help="adapters to accept hosts on, 0 for hci0. Default is 0")
+
 if __name__ == '__main__':
     # The sockets require root permission
     if not os.geteuid() == 0:
         sys.exit('Only root can run this script')
 
+    args = parser.parse_args()
+    setup_logging(args.log_level)
+
     DBusGMainLoop(set_as_default=True)
-    myservice = BTKbService()
+    known_hosts = KnownHosts(args.hosts_file) if args.hosts_file else None
+    myservice = BTKbService(args.hci, args.stats_interval, args.ring_size,
+                            args.trace, args.dedup, known_hosts=known_hosts,
+                            tick=args.tick)
     mainloop = GLib.MainLoop()
     mainloop.run()
\ No newline at end of file
@@ -0,0 +1,26 @@
+"""
+asyncio client library for the Bluetooth HID service.
+One event loop can forward several input devices and run automation
+tasks next to them:
+
+    service = await HIDService(use_socket=True).connect()
+    await asyncio.gather(forward_device(keyboard, service),
+                         forward_device(mouse, service))
+
+The package uses the modules at the top of the repository (hid_descriptor,
+hotplug, input_state, keymap, report_state, report_transport), run it
+from the repository root or put the root on PYTHONPATH.
+"""
+try:
+    import input_state  # noqa: F401
+except ImportError as ex:
+    raise ImportError('btkclient needs the modules at the top of the '
+                      'repository, run it from the repository root or '
+                      'add the root to PYTHONPATH') from ex
+
+from .service import HIDService, HID_DBUS, HID_SRVC
+from .devices import forward_device, forward_keyboard, forward_mouse, \
+    is_mouse
+
+__all__ = ['HIDService', 'HID_DBUS', 'HID_SRVC', 'forward_device',
+           'forward_keyboard', 'forward_mouse', 'is_mouse']
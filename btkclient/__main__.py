@@ -0,0 +1,34 @@
+"""
+Forward input devices to the HID service from one event loop:
+python3 -m btkclient /dev/input/event0 /dev/input/event3
+"""
+import argparse
+import asyncio
+
+import evdev
+
+from .devices import forward_device
+from .service import HIDService
+
+
+async def main(paths, use_socket):
+    service = await HIDService(use_socket=use_socket).connect()
+    devices = [evdev.InputDevice(path) for path in paths]
+    for device in devices:
+        print("Forwarding " + device.name)
+    try:
+        await asyncio.gather(*(forward_device(device, service)
+                               for device in devices))
+    finally:
+        service.disconnect()
+
+
+parser = argparse.ArgumentParser(
+    prog="btkclient",
+    description="Forward several input devices to the HID service from one asyncio event loop")
+parser.add_argument('devices', nargs='+', help="input device paths, /dev/input/eventN")
+parser.add_argument('--socket', action='store_true', help="send reports over the local report socket instead of D-Bus")
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    asyncio.run(main(args.devices, args.socket))
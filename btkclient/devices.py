@@ -0,0 +1,64 @@
+"""
+evdev readers forwarding input devices to the HID service.
+The events are translated by input_state, the same way the keyboard and
+mouse clients do it.
+"""
+import keymap
+from hotplug import classify, MOUSE as MOUSE_DEVICE
+from input_state import KeyboardState, MouseState
+from report_state import ReportState
+
+
+def is_mouse(device):
+    """
+    Classify a device by its capabilities, see hotplug.classify
+    :return: True for a device with relative X/Y axes and a left button
+    """
+    return classify(device) == MOUSE_DEVICE
+
+
+async def forward_keyboard(device, service, table=keymap.table, nkro=False):
+    """
+    Send the key events of a device as keyboard reports
+    :param device: evdev.InputDevice
+    :param service: connected HIDService
+    :param table: key code table, see keymap.compile_table
+    :param nkro: send N-key rollover reports instead of 6 key reports
+    """
+    keyboard = KeyboardState(table, nkro)
+    state = ReportState()
+    async for event in device.async_read_loop():
+        if not keyboard.key_event(event):
+            continue
+        report = keyboard.state
+        if state.changed(report):
+            await service.send_report(report)
+
+
+async def forward_mouse(device, service, hires=False):
+    """
+    Send the events of a device as mouse reports, one report per evdev
+    frame unless the movement does not fit in one
+    :param device: evdev.InputDevice
+    :param service: connected HIDService
+    :param hires: send the high resolution mouse report
+    """
+    mouse = MouseState(hires)
+    mouse.attach_device(device)
+    state = ReportState()
+    async for event in device.async_read_loop():
+        if not mouse.accumulate_event(event, device):
+            continue
+        for report in mouse.frame_reports():
+            if state.changed(report):
+                await service.send_report(report)
+
+
+async def forward_device(device, service):
+    """
+    Forward a device as a mouse or as a keyboard depending on what it can do
+    """
+    if is_mouse(device):
+        await forward_mouse(device, service)
+    else:
+        await forward_keyboard(device, service)
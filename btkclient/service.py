@@ -0,0 +1,158 @@
+"""
+asyncio client of the org.yaptb.btkbservice D-Bus service
+"""
+import asyncio
+import logging
+import socket
+
+from dbus_next import BusType, Message, MessageFlag, MessageType
+from dbus_next.aio import MessageBus
+from dbus_next.errors import DBusError
+
+from report_transport import REPORT_SOCKET_PATH
+
+HID_DBUS = 'org.yaptb.btkbservice'
+HID_SRVC = '/org/yaptb/btkbservice'
+
+logger = logging.getLogger('btkclient')
+
+
+class HIDService:
+    """
+    Non-blocking connection to the HID service.
+    send_keys/send_mouse wait for the reply of the service, the _nowait
+    variants are pipelined: the call is written to the bus without asking
+    for a reply. send_report uses the report socket when it is enabled.
+    """
+
+    def __init__(self, use_socket=False, socket_path=REPORT_SOCKET_PATH,
+                 bus_address=None):
+        self.use_socket = use_socket
+        self.socket_path = socket_path
+        self.bus_address = bus_address
+        self.bus = None
+        self.sock = None
+        # writes of the _nowait calls that are not done yet, kept so they
+        # are not garbage collected before they finish
+        self.pending = set()
+
+    async def connect(self):
+        if self.bus_address is None:
+            bus = MessageBus(bus_type=BusType.SYSTEM)
+        else:
+            bus = MessageBus(bus_address=self.bus_address)
+        self.bus = await bus.connect()
+        if self.use_socket:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+            self.sock.setblocking(False)
+            await asyncio.get_running_loop().sock_connect(self.sock,
+                                                          self.socket_path)
+        return self
+
+    def disconnect(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        if self.bus is not None:
+            self.bus.disconnect()
+            self.bus = None
+
+    def _message(self, member, signature, body, flags=MessageFlag.NONE):
+        return Message(destination=HID_DBUS, path=HID_SRVC,
+                       interface=HID_DBUS, member=member,
+                       signature=signature, body=body, flags=flags)
+
+    async def call(self, member, signature='', body=()):
+        """
+        Call a method of the service and wait for the reply
+        :return: list with the values returned
+        """
+        reply = await self.bus.call(self._message(member, signature,
+                                                  list(body)))
+        if reply.message_type == MessageType.ERROR:
+            raise DBusError(reply.error_name,
+                            reply.body[0] if reply.body else '', reply)
+        return reply.body
+
+    def call_nowait(self, member, signature='', body=()):
+        """
+        Call a method of the service without waiting for, or asking for,
+        a reply
+        """
+        future = self.bus.send(self._message(member, signature, list(body),
+                                             MessageFlag.NO_REPLY_EXPECTED))
+        self.pending.add(future)
+        future.add_done_callback(self._sent)
+
+    def _sent(self, future):
+        self.pending.discard(future)
+        if not future.cancelled() and future.exception() is not None:
+            logger.warning('Could not send a call to the service: {}'.format(
+                future.exception()))
+
+    async def send_keys(self, report):
+        await self.call('send_keys', 'ay', [bytes(report)])
+
+    async def send_mouse(self, report):
+        await self.call('send_mouse', 'ay', [bytes(report)])
+
+    def send_keys_nowait(self, report):
+        self.call_nowait('send_keys', 'ay', [bytes(report)])
+
+    def send_mouse_nowait(self, report):
+        self.call_nowait('send_mouse', 'ay', [bytes(report)])
+
+    async def send_report(self, report):
+        """
+        Send any report the fastest way available, without a reply
+        """
+        if self.sock is not None:
+            await asyncio.get_running_loop().sock_sendall(self.sock,
+                                                          bytes(report))
+        else:
+            self.send_keys_nowait(report)
+
+    async def send_batch(self, reports):
+        """
+        :param reports: list of (report, delay in microseconds after it)
+        :return: number of reports waiting in the service
+        """
+        body = [[bytes(report), delay] for report, delay in reports]
+        return (await self.call('send_batch', 'a(ayu)', [body]))[0]
+
+    async def type_text(self, text, layout='', rate=0):
+        """
+        :return: characters per second achieved
+        """
+        return (await self.call('type_text', 'ssu', [text, layout, rate]))[0]
+
+    async def get_counters(self):
+        return (await self.call('get_counters'))[0]
+
+    async def get_stats(self):
+        return (await self.call('GetStats'))[0]
+
+    async def get_leds(self):
+        """
+        :return: keyboard LED bits, see hid_descriptor.LED_NUM_LOCK
+        """
+        return (await self.call('get_leds'))[0]
+
+    async def watch_leds(self, callback):
+        """
+        Call callback with the host address and the LED bits every time a
+        host sets its keyboard LEDs
+        """
+        rule = "type='signal',interface='{}',member='LedsChanged'".format(
+            HID_DBUS)
+        await self.bus.call(Message(
+            destination='org.freedesktop.DBus', path='/org/freedesktop/DBus',
+            interface='org.freedesktop.DBus', member='AddMatch',
+            signature='s', body=[rule]))
+
+        def handler(message):
+            if message.message_type == MessageType.SIGNAL \
+                    and message.interface == HID_DBUS \
+                    and message.member == 'LedsChanged':
+                callback(*message.body)
+        self.bus.add_message_handler(handler)
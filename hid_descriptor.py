@@ -0,0 +1,511 @@
+"""
+HID report descriptor compiler.
+Every report is defined once below as a list of fields. The report
+descriptor in the SDP record and a struct.Struct packer for each report
+ID are both compiled from these definitions, so a new report is added
+here instead of as hex in sdp_record.xml and byte lists in the clients.
+
+    report = KEYBOARD.pack(modifiers, key1, key2, key3, key4, key5, key6)
+    check(report)  # raises ValueError unless the descriptor has it
+"""
+import struct
+import xml.etree.ElementTree as ET
+
+# first byte of every report on the interrupt channel: DATA | Input
+DATA_INPUT = 0xA1
+
+# first byte of an output report the host sends: DATA | Output
+DATA_OUTPUT = 0xA2
+# first byte of a feature report in GET_REPORT replies: DATA | Feature
+DATA_FEATURE = 0xA3
+
+# flags of the Input, Output and Feature main items
+CONSTANT = 0x01
+VARIABLE = 0x02
+RELATIVE = 0x04
+
+# main items
+INPUT = 0x80
+OUTPUT = 0x90
+FEATURE = 0xB0
+
+# usage pages
+GENERIC_DESKTOP = 0x01
+KEYBOARD_PAGE = 0x07
+LED_PAGE = 0x08
+BUTTON_PAGE = 0x09
+CONSUMER_PAGE = 0x0C
+
+# usages of the generic desktop page
+USAGE_POINTER = 0x01
+USAGE_MOUSE = 0x02
+USAGE_KEYBOARD = 0x06
+USAGE_X = 0x30
+USAGE_Y = 0x31
+USAGE_WHEEL = 0x38
+USAGE_RESOLUTION_MULTIPLIER = 0x48
+# usage of the consumer page
+USAGE_AC_PAN = 0x0238
+
+# keyboard LEDs, bits of the output report of KEYBOARD
+LED_NUM_LOCK = 0x01
+LED_CAPS_LOCK = 0x02
+LED_SCROLL_LOCK = 0x04
+LED_COMPOSE = 0x08
+LED_KANA = 0x10
+
+# collection types
+PHYSICAL = 0x00
+APPLICATION = 0x01
+LOGICAL = 0x02
+
+# short item prefixes without the size bits
+_USAGE_PAGE = 0x04
+_LOGICAL_MIN = 0x14
+_LOGICAL_MAX = 0x24
+_PHYSICAL_MIN = 0x34
+_PHYSICAL_MAX = 0x44
+_REPORT_SIZE = 0x74
+_REPORT_ID = 0x84
+_REPORT_COUNT = 0x94
+_USAGE = 0x08
+_USAGE_MIN = 0x18
+_USAGE_MAX = 0x28
+_COLLECTION = 0xA0
+_END_COLLECTION = 0xC0
+
+# struct codes of byte aligned values by (bits, signed)
+_CODES = {(8, False): 'B', (8, True): 'b', (16, False): 'H',
+          (16, True): 'h', (32, False): 'I', (32, True): 'i'}
+
+
+def item(prefix, value=None, signed=False):
+    """
+    Encode a short item with the smallest data size that holds value
+    :param prefix: item tag and type, see the _ constants
+    :param value: item data, None for an item without data
+    :param signed: encode value as a signed number
+    :return: (bytes) the item
+    """
+    if value is None:
+        return bytes([prefix])
+    for size, size_bits in ((1, 1), (2, 2), (4, 3)):
+        if signed:
+            fits = -(1 << (8 * size - 1)) <= value < 1 << (8 * size - 1)
+        else:
+            fits = 0 <= value < 1 << (8 * size)
+        if fits:
+            return bytes([prefix | size_bits]) + value.to_bytes(
+                size, 'little', signed=signed)
+    raise ValueError('{} does not fit in a short item'.format(value))
+
+
+class Field:
+    """
+    Input, Output or Feature item of count values of size bits each
+    :param name: name of the value, None for padding
+    :param size: bits of each value
+    :param count: number of values
+    :param usage_page: usage page of the values, None to keep the last one
+    :param usages: usages of the values
+    :param usage_range: (first, last) usage instead of usages
+    :param logical: (min, max) of the values, signed if min is negative
+    :param physical: (min, max) the logical range stands for, (0, 0) for
+    the logical range itself
+    :param flags: main item flags, 0 for an array of usages
+    :param main: INPUT, OUTPUT or FEATURE
+    """
+
+    def __init__(self, name, size, count=1, usage_page=None, usages=(),
+                 usage_range=None, logical=(0, 1), physical=(0, 0),
+                 flags=VARIABLE, main=INPUT):
+        self.name = name
+        self.size = size
+        self.count = count
+        self.usage_page = usage_page
+        self.usages = usages
+        self.usage_range = usage_range
+        self.logical = logical
+        self.physical = physical
+        self.flags = flags if name is not None else CONSTANT
+        self.main = main
+
+    @property
+    def signed(self):
+        return self.logical[0] < 0
+
+
+class Collection:
+    """
+    Fields grouped in a collection inside a report, a Resolution
+    Multiplier applies to the controls of its logical collection
+    :param fields: Field list
+    :param kind: collection type
+    """
+
+    def __init__(self, fields, kind=LOGICAL):
+        self.fields = fields
+        self.kind = kind
+
+
+def _flatten(fields):
+    for field in fields:
+        if isinstance(field, Collection):
+            yield from _flatten(field.fields)
+        else:
+            yield field
+
+
+def _compile_struct(report_id, fields):
+    """
+    Values of less than 8 bits are packed together with the fields that
+    follow them into one integer, or bytes when it is not 8, 16 or 32 bits
+    :param fields: fields of one main item type
+    :return: (value names, struct.Struct with the 2 header bytes, slice
+    of the relative bytes, struct.Struct of the relative values, list of
+    (min, max) of the relative values)
+    """
+    codes = ['<BB']
+    names = []
+    relative = []
+    relative_codes = ['<']
+    limits = []
+    offset = 2  # DATA header and report ID
+    bits = 0
+    group = []
+    for field in fields:
+        total = field.size * field.count
+        if bits == 0 and (field.size, field.signed) in _CODES:
+            if field.name is None:
+                codes.append('{}x'.format(total // 8))
+            else:
+                codes.append(_CODES[field.size, field.signed] * field.count)
+                names.extend([field.name] if field.count == 1 else
+                             ['{}{}'.format(field.name, index)
+                              for index in range(field.count)])
+            if field.flags & RELATIVE:
+                relative.extend((offset, offset + total // 8))
+                relative_codes.append(_CODES[field.size, field.signed]
+                                      * field.count)
+                limits.extend([field.logical] * field.count)
+            offset += total // 8
+            continue
+        if field.name is not None:
+            group.append(field.name)
+        bits += total
+        if bits % 8 == 0:
+            codes.append(_CODES.get((bits, False), '{}s'.format(bits // 8)))
+            names.append('+'.join(group))
+            offset += bits // 8
+            bits = 0
+            group = []
+    if bits:
+        raise ValueError('report {} does not end on a byte'.format(
+            report_id))
+    if relative:
+        relative = slice(min(relative), max(relative))
+        relative_struct = struct.Struct(''.join(relative_codes))
+        if relative_struct.size != relative.stop - relative.start:
+            raise ValueError('relative fields of report {} are not next to '
+                             'each other'.format(report_id))
+    else:
+        relative = relative_struct = None
+    return (names, struct.Struct(''.join(codes)), relative, relative_struct,
+            limits)
+
+
+class Report:
+    """
+    Input report, and optional output and feature reports, of one report
+    ID in its own application collection
+    :param report_id: report ID, second byte of the report
+    :param usage: generic desktop usage of the application collection
+    :param fields: Field and Collection list in report order
+    :param physical_usage: optional usage of the physical collection
+    """
+
+    def __init__(self, report_id, usage, fields, physical_usage=None):
+        self.report_id = report_id
+        self.usage = usage
+        self.fields = fields
+        self.physical_usage = physical_usage
+        self.descriptor = self._compile_descriptor()
+        inputs = [field for field in _flatten(fields)
+                  if field.main == INPUT]
+        outputs = [field for field in _flatten(fields)
+                   if field.main == OUTPUT]
+        features = [field for field in _flatten(fields)
+                    if field.main == FEATURE]
+        (self.names, self.struct, self.relative, self.relative_struct,
+         self.relative_limits) = _compile_struct(report_id, inputs)
+        self.size = self.struct.size
+        # output report, sent by the host with SET_REPORT or DATA
+        self.output_names = self.output = None
+        if outputs:
+            self.output_names, self.output = _compile_struct(
+                report_id, outputs)[:2]
+        # feature report, GET_REPORT and SET_REPORT on the control channel
+        self.feature_names = self.feature = None
+        if features:
+            self.feature_names, self.feature = _compile_struct(
+                report_id, features)[:2]
+
+    def _compile_descriptor(self):
+        items = [item(_USAGE_PAGE, GENERIC_DESKTOP),
+                 item(_USAGE, self.usage),
+                 item(_COLLECTION, APPLICATION),
+                 item(_REPORT_ID, self.report_id)]
+        if self.physical_usage is not None:
+            items.append(item(_USAGE, self.physical_usage))
+        items.append(item(_COLLECTION, PHYSICAL))
+        # global items keep their value, only changes are written
+        state = {_USAGE_PAGE: GENERIC_DESKTOP, _PHYSICAL_MIN: 0,
+                 _PHYSICAL_MAX: 0}
+
+        def set_global(prefix, value, signed=False):
+            if state.get(prefix) != value:
+                state[prefix] = value
+                items.append(item(prefix, value, signed))
+
+        def add(fields):
+            for field in fields:
+                if isinstance(field, Collection):
+                    items.append(item(_COLLECTION, field.kind))
+                    add(field.fields)
+                    items.append(item(_END_COLLECTION))
+                    continue
+                if field.name is not None:
+                    if field.usage_page is not None:
+                        set_global(_USAGE_PAGE, field.usage_page)
+                    items.extend(item(_USAGE, usage)
+                                 for usage in field.usages)
+                    if field.usage_range is not None:
+                        items.append(item(_USAGE_MIN, field.usage_range[0]))
+                        items.append(item(_USAGE_MAX, field.usage_range[1]))
+                    set_global(_LOGICAL_MIN, field.logical[0], True)
+                    set_global(_LOGICAL_MAX, field.logical[1], True)
+                    set_global(_PHYSICAL_MIN, field.physical[0], True)
+                    set_global(_PHYSICAL_MAX, field.physical[1], True)
+                set_global(_REPORT_SIZE, field.size)
+                set_global(_REPORT_COUNT, field.count)
+                items.append(item(field.main, field.flags))
+
+        add(self.fields)
+        items.append(item(_END_COLLECTION))
+        items.append(item(_END_COLLECTION))
+        return b''.join(items)
+
+    def pack(self, *values):
+        """
+        :param values: one value per name in self.names
+        :return: (bytes) the report with its header
+        """
+        return self.struct.pack(DATA_INPUT, self.report_id, *values)
+
+    def unpack(self, report):
+        """
+        :return: tuple with one value per name in self.names
+        """
+        return self.struct.unpack(report)[2:]
+
+    def unpack_output(self, report):
+        """
+        :param report: (bytes) output report with its header
+        :return: tuple with one value per name in self.output_names
+        """
+        return self.output.unpack(report)[2:]
+
+    def pack_feature(self, *values):
+        """
+        :param values: one value per name in self.feature_names
+        :return: (bytes) the feature report as GET_REPORT returns it
+        """
+        return self.feature.pack(DATA_FEATURE, self.report_id, *values)
+
+    def buffer(self):
+        """
+        :return: (bytearray) empty report with its header, to be updated
+        in place
+        """
+        buffer = bytearray(self.size)
+        buffer[0] = DATA_INPUT
+        buffer[1] = self.report_id
+        return buffer
+
+
+KEYBOARD = Report(0x01, USAGE_KEYBOARD, [
+    Field('modifiers', 1, 8, KEYBOARD_PAGE, usage_range=(0xE0, 0xE7)),
+    Field(None, 8),
+    Field('leds', 1, 5, LED_PAGE, usage_range=(LED_NUM_LOCK, 0x05),
+          main=OUTPUT),
+    Field(None, 3, main=OUTPUT),
+    # boot keyboard: 6 keys up to Keyboard Application (0x65)
+    Field('key', 8, 6, KEYBOARD_PAGE, usage_range=(0x00, 0x65),
+          logical=(0x00, 0x65), flags=0),
+])
+
+MOUSE = Report(0x02, USAGE_MOUSE, [
+    Field('buttons', 1, 3, BUTTON_PAGE, usage_range=(0x01, 0x03)),
+    Field(None, 5),
+    Field('x', 8, usage_page=GENERIC_DESKTOP, usages=(USAGE_X,),
+          logical=(-127, 127), flags=VARIABLE | RELATIVE),
+    Field('y', 8, usages=(USAGE_Y,), logical=(-127, 127),
+          flags=VARIABLE | RELATIVE),
+    Field('wheel', 8, usages=(USAGE_WHEEL,), logical=(-127, 127),
+          flags=VARIABLE | RELATIVE),
+], physical_usage=USAGE_POINTER)
+
+# N-key rollover: one bit for every HID usage of the keyboard page
+NKRO = Report(0x03, USAGE_KEYBOARD, [
+    Field('modifiers', 1, 8, KEYBOARD_PAGE, usage_range=(0xE0, 0xE7)),
+    Field('keys', 1, 256, usage_range=(0x00, 0xFF)),
+])
+
+# counts per wheel detent of the high resolution wheels, the same as
+# REL_WHEEL_HI_RES
+WHEEL_RESOLUTION = 120
+# largest movement of the high resolution mouse report
+MAX_HIRES_DELTA = 32767
+
+# high resolution mouse: 16 bit movement, and a vertical and horizontal
+# wheel in 1/WHEEL_RESOLUTION of a detent once the host has set their
+# Resolution Multiplier feature to 1. Until then a count is a detent
+HIRES_MOUSE = Report(0x04, USAGE_MOUSE, [
+    Field('buttons', 1, 3, BUTTON_PAGE, usage_range=(0x01, 0x03)),
+    Field(None, 5),
+    Field('x', 16, usage_page=GENERIC_DESKTOP, usages=(USAGE_X,),
+          logical=(-MAX_HIRES_DELTA, MAX_HIRES_DELTA),
+          flags=VARIABLE | RELATIVE),
+    Field('y', 16, usages=(USAGE_Y,),
+          logical=(-MAX_HIRES_DELTA, MAX_HIRES_DELTA),
+          flags=VARIABLE | RELATIVE),
+    Collection([
+        Field('wheel_multiplier', 2,
+              usages=(USAGE_RESOLUTION_MULTIPLIER,), logical=(0, 1),
+              physical=(1, WHEEL_RESOLUTION), main=FEATURE),
+        Field('wheel', 16, usages=(USAGE_WHEEL,),
+              logical=(-MAX_HIRES_DELTA, MAX_HIRES_DELTA),
+              flags=VARIABLE | RELATIVE),
+    ]),
+    Collection([
+        Field('pan_multiplier', 2, usage_page=GENERIC_DESKTOP,
+              usages=(USAGE_RESOLUTION_MULTIPLIER,), logical=(0, 1),
+              physical=(1, WHEEL_RESOLUTION), main=FEATURE),
+        Field('pan', 16, usage_page=CONSUMER_PAGE, usages=(USAGE_AC_PAN,),
+              logical=(-MAX_HIRES_DELTA, MAX_HIRES_DELTA),
+              flags=VARIABLE | RELATIVE),
+    ]),
+    Field(None, 4, main=FEATURE),
+], physical_usage=USAGE_POINTER)
+
+# every report of the descriptor by report ID
+REPORTS = {report.report_id: report
+           for report in (KEYBOARD, MOUSE, NKRO, HIRES_MOUSE)}
+
+
+# boot protocol reports over Bluetooth keep their report ID: the 6 key
+# keyboard report already is the boot keyboard report, the boot mouse
+# report is the mouse report without its wheel
+BOOT_MOUSE = struct.Struct('<BBBbb')  # header, report ID, buttons, x, y
+# key code of a boot keyboard report with too many keys down
+ERROR_ROLL_OVER = 0x01
+
+
+def _clamp_boot(value):
+    return max(-127, min(127, value))
+
+
+def boot_report(report):
+    """
+    Convert a report to the boot protocol, for hosts that asked for it
+    with SET_PROTOCOL. Keyboard reports become the boot keyboard report
+    with report ID 1, mouse reports the boot mouse report with report
+    ID 2
+    :param report: (bytes-like) input report of the descriptor
+    :return: (bytes-like) the boot report, None if it has no boot
+    equivalent
+    """
+    report_id = report[1]
+    if report_id == KEYBOARD.report_id:
+        return report
+    if report_id == MOUSE.report_id:
+        return report[:BOOT_MOUSE.size]
+    if report_id == NKRO.report_id:
+        keys = []
+        for index, bits in enumerate(report[3:]):
+            while bits:
+                low = bits & -bits
+                keys.append(index * 8 + low.bit_length() - 1)
+                bits ^= low
+        if len(keys) > 6:
+            keys = [ERROR_ROLL_OVER] * 6
+        else:
+            keys.extend([0] * (6 - len(keys)))
+        return KEYBOARD.pack(report[2], *keys)
+    if report_id == HIRES_MOUSE.report_id:
+        buttons, x, y = HIRES_MOUSE.unpack(report)[:3]
+        return BOOT_MOUSE.pack(DATA_INPUT, MOUSE.report_id, buttons,
+                               _clamp_boot(x), _clamp_boot(y))
+    return None
+
+
+def descriptor():
+    """
+    :return: (bytes) report descriptor with every report in REPORTS
+    """
+    return b''.join(report.descriptor for report in REPORTS.values())
+
+
+def relative_fields():
+    """
+    :return: dict of the slice of the relative bytes by report ID
+    """
+    return {report_id: report.relative
+            for report_id, report in REPORTS.items()
+            if report.relative is not None}
+
+
+def check(report):
+    """
+    Check that a report is an input report of the descriptor
+    :param report: (bytes) HID packet
+    :return: Report of its report ID
+    :raise ValueError: if the descriptor has no such report
+    """
+    if len(report) < 2 or report[0] != DATA_INPUT:
+        raise ValueError('Not an input report')
+    definition = REPORTS.get(report[1])
+    if definition is None:
+        raise ValueError('Unknown report ID {}'.format(report[1]))
+    if len(report) != definition.size:
+        raise ValueError('Report {} has {} bytes instead of {}'.format(
+            report[1], len(report), definition.size))
+    return definition
+
+
+def sdp_record(template):
+    """
+    Put the report descriptor in an SDP record
+    :param template: (str) SDP record XML, see sdp_record.xml
+    :return: (str) the record with the compiled descriptor
+    """
+    record = ET.fromstring(template)
+    value = record.find(
+        "./attribute[@id='0x0206']/sequence/sequence/text[@encoding='hex']")
+    value.set('value', descriptor().hex().upper())
+    return ET.tostring(record, encoding='unicode')
+
+
+if __name__ == '__main__':
+    for report in REPORTS.values():
+        print('{} {} bytes: {}'.format(report.report_id, report.size,
+                                       ', '.join(report.names)))
+        if report.output is not None:
+            print('{} output {} bytes: {}'.format(
+                report.report_id, report.output.size,
+                ', '.join(report.output_names)))
+        if report.feature is not None:
+            print('{} feature {} bytes: {}'.format(
+                report.report_id, report.feature.size,
+                ', '.join(report.feature_names)))
+    print(descriptor().hex().upper())
@@ -0,0 +1,182 @@
+"""
+Input device hotplug.
+/dev/input is watched with inotify, so devices are attached as soon as
+their node appears (or becomes readable) and detached when it goes away.
+Devices are classified by what they can do, not by their name, and every
+matching device is served at the same time.
+"""
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+
+import evdev
+from evdev import ecodes
+
+INPUT_DIR = '/dev/input'
+
+# inotify flags, see inotify(7)
+IN_ATTRIB = 0x00000004
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+# wd, mask, cookie, len of the name that follows
+INOTIFY_EVENT = struct.Struct('iIII')
+
+KEYBOARD = 'keyboard'
+MOUSE = 'mouse'
+
+# keys a device needs to count as a keyboard
+KEYBOARD_KEYS = (ecodes.KEY_A, ecodes.KEY_Z, ecodes.KEY_SPACE,
+                 ecodes.KEY_ENTER)
+
+
+def classify(device):
+    """
+    Find what kind of input device this is from its capabilities
+    :param device: evdev.InputDevice
+    :return: MOUSE, KEYBOARD or None
+    """
+    capabilities = device.capabilities()
+    keys = capabilities.get(ecodes.EV_KEY, [])
+    rel = capabilities.get(ecodes.EV_REL, [])
+    if ecodes.REL_X in rel and ecodes.REL_Y in rel \
+            and ecodes.BTN_LEFT in keys:
+        return MOUSE
+    if all(key in keys for key in KEYBOARD_KEYS):
+        return KEYBOARD
+    return None
+
+
+class Inotify:
+    """
+    Minimal inotify watch on one directory
+    """
+
+    def __init__(self, path, mask):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                                use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        if self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask) < 0:
+            err = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(err, os.strerror(err), path)
+
+    def fileno(self):
+        return self.fd
+
+    def read(self):
+        """
+        :return: list of (mask, name) of the pending events
+        """
+        try:
+            data = os.read(self.fd, 4096)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            _, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            events.append((mask, os.fsdecode(name)))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class DeviceManager:
+    """
+    Keep every input device of the wanted kinds open
+    :param kinds: kinds of devices to serve, KEYBOARD and/or MOUSE
+    :param on_attach: optional function called with a new device
+    :param on_detach: optional function called with a removed device
+    """
+
+    def __init__(self, kinds, on_attach=None, on_detach=None,
+                 path=INPUT_DIR):
+        self.kinds = kinds
+        self.on_attach = on_attach
+        self.on_detach = on_detach
+        self.path = path
+        self.devices = {}  # InputDevice by device path
+        # watch before scanning, so no device can slip in between
+        self.inotify = Inotify(path, IN_CREATE | IN_ATTRIB | IN_DELETE)
+        for device_path in evdev.list_devices(path):
+            self._attach(device_path)
+
+    def _attach(self, device_path):
+        if device_path in self.devices:
+            return
+        try:
+            device = evdev.InputDevice(device_path)
+        except OSError:
+            # udev has not given access yet, IN_ATTRIB follows
+            return
+        if classify(device) not in self.kinds:
+            device.close()
+            return
+        self.devices[device_path] = device
+        print('Attached {} {}'.format(device_path, device.name))
+        if self.on_attach is not None:
+            self.on_attach(device)
+
+    def _detach(self, device_path):
+        device = self.devices.pop(device_path, None)
+        if device is None:
+            return
+        print('Detached {} {}'.format(device_path, device.name))
+        try:
+            device.close()
+        except OSError:
+            pass
+        if self.on_detach is not None:
+            self.on_detach(device)
+
+    def _hotplug(self):
+        for mask, name in self.inotify.read():
+            if not name.startswith('event'):
+                continue
+            device_path = os.path.join(self.path, name)
+            if mask & IN_DELETE:
+                self._detach(device_path)
+            elif mask & (IN_CREATE | IN_ATTRIB):
+                self._attach(device_path)
+
+    def events(self):
+        """
+        Read the events of all attached devices, attaching and detaching
+        devices as they come and go
+        :return: generator of (device, event)
+        """
+        while True:
+            readable, _, _ = select.select(
+                [self.inotify, *self.devices.values()], [], [])
+            for source in readable:
+                if source is self.inotify:
+                    self._hotplug()
+                    continue
+                if source.path not in self.devices:
+                    continue
+                try:
+                    for event in source.read():
+                        yield source, event
+                except BlockingIOError:
+                    pass
+                except OSError as ex:
+                    if ex.errno != errno.EAGAIN:
+                        # unplugged before inotify told us
+                        self._detach(source.path)
+
+    def close(self):
+        for device_path in list(self.devices):
+            self._detach(device_path)
+        self.inotify.close()
@@ -0,0 +1,127 @@
+"""
+Binary input logs for record and replay.
+A log is a header followed by fixed size records, so it can be appended
+to while it is recorded and read straight from a memory map when it is
+replayed, record by record, however long the capture is.
+A log holds either the evdev events of a keyboard or a mouse client, or
+the HID reports a client sent. Times are wall clock seconds, the clock
+of evdev timestamps.
+"""
+import mmap
+import struct
+import time
+
+import hid_descriptor
+
+MAGIC = b'BTKL'
+VERSION = 1
+# magic, version, kind of records, record size
+HEADER = struct.Struct('<4sBBH8x')
+
+# kinds of records
+KEYBOARD_EVENTS = 1
+MOUSE_EVENTS = 2
+REPORTS = 3
+
+# time, type, code, value
+EVENT = struct.Struct('<dHHi')
+# largest report of the descriptor
+MAX_LOGGED_REPORT = max(report.size
+                        for report in hid_descriptor.REPORTS.values())
+# time, report length, report padded to MAX_LOGGED_REPORT
+REPORT = struct.Struct('<dB{}s'.format(MAX_LOGGED_REPORT))
+
+
+def record_struct(kind):
+    return REPORT if kind == REPORTS else EVENT
+
+
+class Recorder:
+    """
+    Append records to an input log
+    :param path: log file, created if it does not exist
+    :param kind: KEYBOARD_EVENTS, MOUSE_EVENTS or REPORTS
+    """
+
+    def __init__(self, path, kind):
+        self.kind = kind
+        self.record = record_struct(kind)
+        self.file = open(path, 'ab')
+        size = self.file.tell()
+        if size == 0:
+            self.file.write(HEADER.pack(MAGIC, VERSION, kind,
+                                        self.record.size))
+            return
+        with open(path, 'rb') as fh:
+            header = fh.read(HEADER.size)
+        if len(header) < HEADER.size \
+                or HEADER.unpack(header) != (MAGIC, VERSION, kind,
+                                             self.record.size):
+            self.file.close()
+            raise ValueError('{} is not an input log of this kind'.format(
+                path))
+        # a record cut short when the last recording stopped
+        partial = (size - HEADER.size) % self.record.size
+        if partial:
+            self.file.truncate(size - partial)
+
+    def record_event(self, event):
+        """
+        :param event: evdev.InputEvent
+        """
+        self.file.write(EVENT.pack(event.timestamp(), event.type,
+                                   event.code, event.value))
+
+    def record_report(self, report, stamp=None):
+        """
+        :param report: (bytes-like) HID report as sent to the service
+        :param stamp: time it was sent, now if None
+        """
+        self.file.write(REPORT.pack(time.time() if stamp is None else stamp,
+                                    len(report), bytes(report)))
+
+    def close(self):
+        self.file.close()
+
+
+class InputLog:
+    """
+    Memory mapped input log. Iterating it unpacks one record at a time:
+    (time, type, code, value) for events, (time, report) for reports
+    :param path: log file
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as fh:
+            try:
+                self.map = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise ValueError('{} is empty'.format(path))
+        if len(self.map) < HEADER.size:
+            raise ValueError('{} is not an input log'.format(path))
+        magic, version, self.kind, record_size = HEADER.unpack_from(self.map)
+        if magic != MAGIC or version != VERSION \
+                or self.kind not in (KEYBOARD_EVENTS, MOUSE_EVENTS, REPORTS):
+            raise ValueError('{} is not an input log'.format(path))
+        self.record = record_struct(self.kind)
+        if record_size != self.record.size:
+            raise ValueError('{} has records of {} bytes instead of {}'.format(
+                path, record_size, self.record.size))
+
+    def __len__(self):
+        # a record still being written is left out
+        return (len(self.map) - HEADER.size) // self.record.size
+
+    def __iter__(self):
+        unpack_from = self.record.unpack_from
+        end = HEADER.size + len(self) * self.record.size
+        if self.kind == REPORTS:
+            for offset in range(HEADER.size, end, self.record.size):
+                stamp, length, report = unpack_from(self.map, offset)
+                yield stamp, report[:length]
+        else:
+            for offset in range(HEADER.size, end, self.record.size):
+                yield unpack_from(self.map, offset)
+
+    def close(self):
+        self.map.close()
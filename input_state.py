@@ -0,0 +1,226 @@
+"""
+Translation of evdev events into HID reports.
+The keyboard and mouse clients and the asyncio client in btkclient all
+keep their input state here, so the same input gives the same reports
+whichever client reads it.
+"""
+from evdev import ecodes
+
+import keymap
+from hid_descriptor import KEYBOARD, MOUSE, NKRO, HIRES_MOUSE, \
+    WHEEL_RESOLUTION
+
+# largest relative movement of the mouse and high resolution mouse reports
+MAX_DELTA = MOUSE.relative_limits[0][1]
+MAX_HIRES_DELTA = HIRES_MOUSE.relative_limits[0][1]
+
+# bits of the mouse buttons in the mouse reports
+MOUSE_BUTTONS = {
+    ecodes.BTN_LEFT: 0x01,
+    ecodes.BTN_RIGHT: 0x02,
+    ecodes.BTN_MIDDLE: 0x04,
+}
+
+# frame index and high resolution event of the wheels
+WHEELS = {
+    ecodes.REL_WHEEL: (2, ecodes.REL_WHEEL_HI_RES),
+    ecodes.REL_HWHEEL: (3, ecodes.REL_HWHEEL_HI_RES),
+}
+HIRES_WHEELS = {hires: index for index, hires in WHEELS.values()}
+
+
+def clamp_delta(value, limit=MAX_DELTA):
+    return max(-limit, min(limit, value))
+
+
+class KeyboardState:
+    """
+    Keys held on the keyboards and the report that sends them
+    :param table: evdev code to HID translation, see keymap.compile_table
+    :param nkro: send the N-key rollover report instead of the 6 key one
+    """
+
+    def __init__(self, table=keymap.table, nkro=False):
+        self.target_length = 6
+        self.mod_keys = 0b00000000
+        self.pressed_keys = [0] * self.target_length
+        # with nkro the key state is kept in place in the report itself,
+        # a modifier byte and one bit for each of the 256 HID usages
+        self.nkro = nkro
+        self.nkro_report = NKRO.buffer()
+        self.table = table
+
+    def release(self):
+        self.mod_keys = 0
+        self.pressed_keys = [0] * self.target_length
+        self.nkro_report[2:] = bytes(NKRO.size - 2)
+
+    def update_mod_keys(self, mod_key, value):
+        """
+        Which modifier keys are active is stored in an 8 bit number.
+        Each bit represents a different key. This method takes which bit
+        and its new value as input
+        :param mod_key: The value of the bit to be updated with new value
+        :param value: Binary 1 or 0 depending if pressed or released
+        """
+        bit_mask = 1 << (7-mod_key)
+        if value:  # set bit
+            self.mod_keys |= bit_mask
+        else:  # clear bit
+            self.mod_keys &= ~bit_mask
+
+    def update_keys(self, norm_key, value):
+        if self.nkro:
+            self.update_nkro_keys(norm_key, value)
+            return
+        if value < 1:
+            if norm_key in self.pressed_keys:
+                self.pressed_keys.remove(norm_key)
+        elif norm_key not in self.pressed_keys:
+            self.pressed_keys.insert(0, norm_key)
+        len_delta = self.target_length - len(self.pressed_keys)
+        if len_delta < 0:
+            self.pressed_keys = self.pressed_keys[:len_delta]
+        elif len_delta > 0:
+            self.pressed_keys.extend([0] * len_delta)
+
+    def update_nkro_keys(self, norm_key, value):
+        """
+        Set or clear the bit of a HID usage in the NKRO report
+        :param norm_key: HID usage of the key
+        :param value: Binary 1 or 0 depending if pressed or released
+        """
+        index = 3 + (norm_key >> 3)
+        bit_mask = 1 << (norm_key & 0x07)
+        if value:
+            self.nkro_report[index] |= bit_mask
+        else:
+            self.nkro_report[index] &= ~bit_mask & 0xFF
+
+    def key_event(self, event):
+        """
+        Update the keys with an evdev event
+        :return: False if it is not a key going up or down
+        """
+        # only bother if we hit a key and its an up or down event
+        if event.type != ecodes.EV_KEY or event.value > 1:
+            return False
+        entry = self.table[event.code] if event.code < len(self.table) else 0
+        if entry & keymap.MODIFIER:
+            self.update_mod_keys(entry & 0x07, event.value)
+        elif entry:
+            self.update_keys(entry, event.value)
+        return True
+
+    @property
+    def state(self):
+        """
+        property with the HID message to send for the current keys pressed
+        on the keyboards
+        :return: bytes of HID message
+        """
+        if self.nkro:
+            self.nkro_report[2] = self.mod_keys
+            return self.nkro_report
+        return KEYBOARD.pack(self.mod_keys, *self.pressed_keys)
+
+
+class MouseState:
+    """
+    Buttons held on the mice and the movement of the current input frame
+    :param hires: send the high resolution mouse report: 16 bit movement
+    and wheels in 1/WHEEL_RESOLUTION detents
+    """
+
+    def __init__(self, hires=False):
+        self.hires = hires
+        self.buttons = 0
+        self.frame = [0, 0, 0, 0]  # Rel X, Rel Y, Mouse Wheel, AC Pan
+        self.frame_buttons = False
+        # high resolution wheel events each attached mouse has
+        self.hires_codes = {}
+
+    # remember which wheels of a new mouse have high resolution events
+    def attach_device(self, device):
+        rel = device.capabilities().get(ecodes.EV_REL, [])
+        self.hires_codes[device.path] = {code for code in HIRES_WHEELS
+                                         if code in rel}
+
+    # release the buttons and drop the movement, the next frame_reports
+    # sends a report with no button held
+    def release(self, device=None):
+        if device is not None:
+            self.hires_codes.pop(device.path, None)
+        self.buttons = 0
+        self.frame = [0, 0, 0, 0]
+        self.frame_buttons = True
+
+    def button_event(self, event):
+        """
+        :return: False if the event is not a mouse button going up or down
+        """
+        bit = MOUSE_BUTTONS.get(event.code)
+        if event.type != ecodes.EV_KEY or event.value > 1 or bit is None:
+            return False
+        if event.value:
+            self.buttons |= bit
+        else:
+            self.buttons &= ~bit
+        return True
+
+    def accumulate_event(self, event, device=None):
+        """
+        Add an event of a device to the current frame
+        :param device: evdev.InputDevice that sent it, for its wheels
+        :return: True at the end of the frame, frame_reports are due
+        """
+        if self.button_event(event):
+            self.frame_buttons = True
+        elif event.type == ecodes.EV_REL:
+            if event.code == ecodes.REL_X:
+                self.frame[0] += event.value
+            elif event.code == ecodes.REL_Y:
+                self.frame[1] += event.value
+            elif event.code in WHEELS:
+                index, hires_code = WHEELS[event.code]
+                if not self.hires:
+                    # the mouse report has no horizontal wheel
+                    if index == 2:
+                        self.frame[2] += event.value
+                elif device is None or hires_code not in \
+                        self.hires_codes.get(device.path, ()):
+                    self.frame[index] += event.value * WHEEL_RESOLUTION
+            elif event.code in HIRES_WHEELS and self.hires \
+                    and device is not None \
+                    and event.code in self.hires_codes.get(device.path, ()):
+                self.frame[HIRES_WHEELS[event.code]] += event.value
+        elif event.type == ecodes.EV_SYN:
+            if event.code == ecodes.SYN_REPORT:
+                return True
+            if event.code == ecodes.SYN_DROPPED:
+                # the kernel dropped events, the frame is incomplete
+                self.frame = [0, 0, 0, 0]
+        return False
+
+    def frame_reports(self):
+        """
+        Take the reports of the current frame and start the next one
+        :return: list of reports, more than one when the movement does
+        not fit in one report, none when nothing changed
+        """
+        rest = self.frame
+        self.frame = [0, 0, 0, 0]
+        if not (self.frame_buttons or any(rest)):
+            return []
+        self.frame_buttons = False
+        limit = MAX_HIRES_DELTA if self.hires else MAX_DELTA
+        reports = []
+        while True:
+            steps = [clamp_delta(value, limit) for value in rest]
+            rest = [value - step for value, step in zip(rest, steps)]
+            if self.hires:
+                reports.append(HIRES_MOUSE.pack(self.buttons, *steps))
+            else:
+                reports.append(MOUSE.pack(self.buttons, *steps[:3]))
+            if not any(rest):
+                return reports
@@ -1,93 +1,75 @@
+import argparse
+
 import dbus
 import evdev
-from evdev import InputDevice
 import keymap
+from hotplug import DeviceManager, KEYBOARD as KEYBOARD_DEVICE
+from input_log import Recorder, KEYBOARD_EVENTS, REPORTS
+from input_state import KeyboardState
+from report_state import ReportState
+from report_transport import ReportSender
 
 from sshkeyboard import listen_keyboard
 
-from time import sleep
-
 HID_DBUS = 'org.yaptb.btkbservice'
 HID_SRVC = '/org/yaptb/btkbservice'
 
+# KVM hotkey: Right Ctrl + Right Alt (bits of the modifier byte) and 1 to
+# 7 sends the keys to the first to seventh host of get_hosts, sorted by
+# address, 0 to all hosts
+KVM_MODIFIERS = 0x50
+KVM_KEYS = {evdev.ecodes.KEY_0: None,
+            **{getattr(evdev.ecodes, 'KEY_{}'.format(number)): number - 1
+               for number in range(1, 8)}}
+
 
-class Kbrd:
+class Kbrd(KeyboardState):
     """
     Take the events from a physically attached keyboard and send the
     HID messages to the keyboard D-Bus server.
     """
 
-    def __init__(self):
-        self.target_length = 6
-        self.mod_keys = 0b00000000
-        self.pressed_keys = []
-        self.have_kb = False
-        self.dev = None
+    def __init__(self, use_socket=False, trace=False, profile=None,
+                 nkro=False, watch=True, recorder=None, kvm=False):
+        # evdev code to HID translation, see keymap.compile_table
+        super().__init__(
+            keymap.load_profile(profile) if profile else keymap.table, nkro)
         self.bus = dbus.SystemBus()
         self.btkobject = self.bus.get_object(HID_DBUS,
                                              HID_SRVC)
         self.btk_service = dbus.Interface(self.btkobject,
                                           HID_DBUS)
-        self.wait_for_keyboard()
-
-    def wait_for_keyboard(self, event_id=0):
-        """
-        Connect to the input event file for the keyboard.
-        Can take a parameter of an integer that gets appended to the end of
-        /dev/input/event
-        :param event_id: Optional parameter if the keyboard is not event0
+        # socket or D-Bus path of the reports, with or without tracing
+        self.sender = ReportSender(self.btk_service, 'send_keys',
+                                   use_socket, trace)
+        # last report sent, unchanged reports are not sent again
+        self.report_state = ReportState()
+        # every keyboard plugged in, now or later, none when the events
+        # come from a log
+        self.devices = DeviceManager((KEYBOARD_DEVICE,),
+                                     on_detach=self.release_keys) \
+            if watch else None
+        # optional input_log.Recorder of the events or of the reports
+        self.recorder = recorder
+        # switch hosts with the KVM hotkey
+        self.kvm = kvm
+
+    def release_keys(self, device=None):
         """
-        
-        while self.have_kb is False:
-            try:
-                devices = [evdev.InputDevice(fn) for fn in evdev.list_devices()]
-                for device in reversed(devices):
-                    if "keyboard" in device.name.lower():
-                        print("Found a keyboard with the keyword 'keyboard'")
-                        print("device name is " + device.name)
-                        self.dev = InputDevice(device.path)
-                        self.have_kb = True
-                        break
-            except OSError:
-                print('Keyboard not found, waiting 3 seconds and retrying')
-                sleep(3)
-
-    def update_mod_keys(self, mod_key, value):
+        Release everything, so no key stays held on the host when a
+        keyboard is unplugged
+        :param device: the keyboard removed
         """
-        Which modifier keys are active is stored in an 8 bit number.
-        Each bit represents a different key. This method takes which bit
-        and its new value as input
-        :param mod_key: The value of the bit to be updated with new value
-        :param value: Binary 1 or 0 depending if pressed or released
-        """
-        bit_mask = 1 << (7-mod_key)
-        if value:  # set bit
-            self.mod_keys |= bit_mask
-        else:  # clear bit
-            self.mod_keys &= ~bit_mask
-
-    def update_keys(self, norm_key, value):
-        if value < 1:
-            self.pressed_keys.remove(norm_key)
-        elif norm_key not in self.pressed_keys:
-            self.pressed_keys.insert(0, norm_key)
-        len_delta = self.target_length - len(self.pressed_keys)
-        if len_delta < 0:
-            self.pressed_keys = self.pressed_keys[:len_delta]
-        elif len_delta > 0:
-            self.pressed_keys.extend([0] * len_delta)
-
-    @property
-    def state(self):
-        """
-        property with the HID message to send for the current keys pressed
-        on the keyboards
-        :return: bytes of HID message
-        """
-        return [0xA1, 0x01, self.mod_keys, 0, *self.pressed_keys]
+        self.release()
+        self.send_keys()
 
-    def send_keys(self):
-        self.btk_service.send_keys(self.state)
+    def send_keys(self, event_time=None):
+        report = self.state
+        if not self.report_state.changed(report):
+            return
+        if self.recorder is not None and self.recorder.kind == REPORTS:
+            self.recorder.record_report(report)
+        self.sender.send(report, event_time)
 
     def event_loop(self):
         """
@@ -95,17 +77,41 @@ class Kbrd:
         over D-Bus keyboard service when they happen
         """
         print('Listening...')
-        for event in self.dev.read_loop():
-
-            # only bother if we hit a key and its an up or down event
-            if event.type == evdev.ecodes.EV_KEY and event.value < 2:
-                key_str = evdev.ecodes.KEY[event.code]
-                mod_key = keymap.modkey(key_str)
-                if mod_key > -1:
-                    self.update_mod_keys(mod_key, event.value)
-                else:
-                    self.update_keys(keymap.convert(key_str), event.value)
-            self.send_keys()
+        record = self.recorder is not None and self.recorder.kind != REPORTS
+        for device, event in self.devices.events():
+            if record:
+                self.recorder.record_event(event)
+            self.process_event(event)
+
+    def process_event(self, event):
+        """
+        Update the keys with one evdev event and send the new report
+        :param event: evdev.InputEvent, read from a keyboard or a log
+        """
+        if self.kvm and event.type == evdev.ecodes.EV_KEY \
+                and event.value == 1 and event.code in KVM_KEYS \
+                and self.mod_keys & KVM_MODIFIERS == KVM_MODIFIERS:
+            self.switch_host(KVM_KEYS[event.code])
+            return
+        if self.key_event(event):
+            self.send_keys(event.timestamp())
+
+    def switch_host(self, index):
+        """
+        Send the keys to another host, the service releases the keys
+        held on the one before
+        :param index: position of the host in the connected hosts, None
+        for all hosts
+        """
+        try:
+            if index is None:
+                self.btk_service.set_active_host('')
+                return
+            hosts = self.btk_service.get_hosts()
+            if index < len(hosts):
+                self.btk_service.set_active_host(hosts[index])
+        except dbus.DBusException as ex:
+            print('Could not switch host: {}'.format(ex))
 
     def onPress(self, key):
         self.update_keys(keymap.convert(f"KEY_{key.upper()}"), 1)
@@ -119,9 +125,31 @@ class Kbrd:
         listen_keyboard(on_press=self.onPress, on_release=self.onRelease)
 
 
+parser = argparse.ArgumentParser(
+    description="Creates keyboard client sending the keys of a physical keyboard to the HID service")
+parser.add_argument('--socket', action='store_true', help="send reports over the local report socket instead of D-Bus")
+parser.add_argument('--profile', default=None, type=str, help="JSON file remapping keys, see keymap.load_profile")
+parser.add_argument('--nkro', action='store_true', help="send N-key rollover reports instead of the 6 key boot keyboard report")
+parser.add_argument('--trace', action='store_true', help="send event timestamps for the latency statistics of the service")
+parser.add_argument('--kvm', action='store_true', help="switch hosts with Right Ctrl + Right Alt + 1 to 7, or 0 for all hosts")
+parser.add_argument('--record', default=None, type=str, help="append the keyboard events to this input log, see replay.py")
+parser.add_argument('--record-reports', action='store_true', help="log the reports sent instead of the keyboard events")
+
 if __name__ == '__main__':
+    args = parser.parse_args()
+
+    recorder = None
+    if args.record:
+        recorder = Recorder(args.record,
+                            REPORTS if args.record_reports else KEYBOARD_EVENTS)
+
     print('Setting up keyboard')
-    kb = Kbrd()
+    kb = Kbrd(use_socket=args.socket, trace=args.trace, profile=args.profile,
+              nkro=args.nkro, recorder=recorder, kvm=args.kvm)
 
     print('starting event loop')
-    kb.event_loop()
+    try:
+        kb.event_loop()
+    finally:
+        if recorder is not None:
+            recorder.close()
@@ -11,6 +11,12 @@
 #
 # Ported to a Python module by Liam Fraser.
 #
+import json
+from array import array
+
+from evdev import ecodes
+
+from hid_descriptor import KEYBOARD
 
 keytable = {
     "KEY_RESERVED": 0,
@@ -197,4 +203,139 @@ def modkey(evdev_keycode):
     if evdev_keycode in modkeys:
         return modkeys[evdev_keycode]
     else:
-        return -1  # Return an invalid array element
\ No newline at end of file
+        return -1  # Return an invalid array element
+
+
+# Entries of the compiled table. 0 is an unmapped key, a HID usage is
+# stored as is and a modifier key as MODIFIER plus its element in modkeys
+MODIFIER = 0x100
+
+
+def _entry(evdev_keycode):
+    if evdev_keycode in modkeys:
+        return MODIFIER | modkeys[evdev_keycode]
+    return keytable.get(evdev_keycode, 0)
+
+
+def compile_table(remap=None):
+    """
+    Build the table translating evdev key codes, indexed by the code
+    :param remap: optional dict of evdev key name to the evdev key name
+    whose meaning it takes, or to a HID usage
+    :return: array with one entry per evdev key code
+    :raise ValueError: for an unknown key or a HID usage above 255
+    """
+    table = array('H', [0]) * (ecodes.KEY_MAX + 1)
+    for name in keytable:
+        code = ecodes.ecodes.get(name)
+        if code is not None:
+            table[code] = _entry(name)
+    for name, target in (remap or {}).items():
+        code = ecodes.ecodes.get(name)
+        if code is None:
+            raise ValueError('Unknown key {}'.format(name))
+        if isinstance(target, int):
+            # larger values would be read as modifiers or overflow
+            if not 0 <= target <= 0xFF:
+                raise ValueError('HID usage {} of {} is not between 0 and '
+                                 '255'.format(target, name))
+            table[code] = target
+        elif target in keytable:
+            table[code] = _entry(target)
+        else:
+            raise ValueError('Unknown key {}'.format(target))
+    return table
+
+
+def load_profile(path):
+    """
+    Compile a remap profile, a JSON file like
+    {"remap": {"KEY_CAPSLOCK": "KEY_LEFTCTRL", "KEY_F13": 104}}
+    :param path: file path of the profile
+    :return: array with one entry per evdev key code
+    """
+    with open(path) as fh:
+        profile = json.load(fh)
+    return compile_table(profile.get('remap'))
+
+
+# default table without any remapping
+table = compile_table()
+
+
+# Left shift in the modifier byte of a keyboard report
+SHIFT = 1 << (7 - modkeys["KEY_LEFTSHIFT"])
+
+
+def _layout(unshifted, shifted):
+    """
+    Build a character map
+    :param unshifted: dict of character to evdev key name
+    :param shifted: dict of character to evdev key name typed with shift
+    :return: dict of character to (HID usage, modifier byte)
+    """
+    layout = {}
+    for char, name in unshifted.items():
+        layout[char] = (keytable[name], 0)
+    for char, name in shifted.items():
+        layout[char] = (keytable[name], SHIFT)
+    return layout
+
+
+_letters = {chr(c): "KEY_" + chr(c).upper()
+            for c in range(ord("a"), ord("z") + 1)}
+_capitals = {char.upper(): name for char, name in _letters.items()}
+_digits = {str(d): "KEY_{}".format(d) for d in range(10)}
+_common = {" ": "KEY_SPACE", "\n": "KEY_ENTER", "\t": "KEY_TAB",
+           "-": "KEY_MINUS", "=": "KEY_EQUAL", "[": "KEY_LEFTBRACE",
+           "]": "KEY_RIGHTBRACE", ";": "KEY_SEMICOLON", ",": "KEY_COMMA",
+           ".": "KEY_DOT", "/": "KEY_SLASH", "`": "KEY_GRAVE"}
+_common_shifted = {"!": "KEY_1", "$": "KEY_4", "%": "KEY_5", "^": "KEY_6",
+                   "&": "KEY_7", "*": "KEY_8", "(": "KEY_9", ")": "KEY_0",
+                   "_": "KEY_MINUS", "+": "KEY_EQUAL", "{": "KEY_LEFTBRACE",
+                   "}": "KEY_RIGHTBRACE", ":": "KEY_SEMICOLON",
+                   "<": "KEY_COMMA", ">": "KEY_DOT", "?": "KEY_SLASH"}
+
+# Characters of the host keyboard layouts
+layouts = {
+    "us": _layout(
+        {**_letters, **_digits, **_common,
+         "'": "KEY_APOSTROPHE", "\\": "KEY_BACKSLASH"},
+        {**_capitals, **_common_shifted,
+         "@": "KEY_2", "#": "KEY_3", "~": "KEY_GRAVE",
+         "\"": "KEY_APOSTROPHE", "|": "KEY_BACKSLASH"}),
+    "gb": _layout(
+        {**_letters, **_digits, **_common,
+         "'": "KEY_APOSTROPHE", "#": "KEY_BACKSLASH", "\\": "KEY_102ND"},
+        {**_capitals, **_common_shifted,
+         "\"": "KEY_2", "\u00a3": "KEY_3", "@": "KEY_APOSTROPHE",
+         "~": "KEY_BACKSLASH", "|": "KEY_102ND", "\u00ac": "KEY_GRAVE"}),
+}
+
+
+def text_reports(text, layout="us"):
+    """
+    Compile a text into the keyboard reports that type it.
+    Every character is pressed in its own report, which also releases the
+    previous key. A release report is only added when a key repeats.
+    :param text: (str) text to type
+    :param layout: name of the host keyboard layout in layouts
+    :return: list of keyboard reports (bytes)
+    """
+    chars = layouts[layout]
+    reports = []
+    last_usage = None
+    modifiers = 0
+    for char in text:
+        try:
+            usage, modifiers = chars[char]
+        except KeyError:
+            raise ValueError("Can not type {!r} with layout {}".format(
+                char, layout))
+        if usage == last_usage:
+            reports.append(KEYBOARD.pack(modifiers, 0, 0, 0, 0, 0, 0))
+        reports.append(KEYBOARD.pack(modifiers, usage, 0, 0, 0, 0, 0))
+        last_usage = usage
+    if reports:
+        reports.append(KEYBOARD.pack(0, 0, 0, 0, 0, 0, 0))
+    return reports
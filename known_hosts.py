@@ -0,0 +1,73 @@
+"""
+Hosts that connected recently, kept on disk so that after a restart the
+service can connect back to them instead of waiting for them to connect.
+"""
+import json
+import logging
+import os
+
+KNOWN_HOSTS_PATH = '/var/lib/btkbservice/hosts.json'
+
+logger = logging.getLogger('known_hosts')
+
+
+class KnownHosts:
+    """
+    Host addresses per adapter address, most recently connected first
+    :param path: JSON file the hosts are kept in
+    :param limit: hosts kept per adapter
+    """
+
+    def __init__(self, path=KNOWN_HOSTS_PATH, limit=7):
+        self.path = path
+        self.limit = limit
+        self.hosts = self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as fh:
+                hosts = json.load(fh)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as ex:
+            logger.warning('Could not read {}: {}'.format(self.path, ex))
+            return {}
+        if not isinstance(hosts, dict):
+            return {}
+        return {adapter: list(addresses)[:self.limit]
+                for adapter, addresses in hosts.items()}
+
+    def save(self):
+        """
+        Write the file in one step, a crash leaves the old file or the new
+        one but never half of it
+        """
+        temp = self.path + '.tmp'
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(temp, 'w') as fh:
+                json.dump(self.hosts, fh, indent=1)
+            os.replace(temp, self.path)
+        except OSError as ex:
+            logger.warning('Could not write {}: {}'.format(self.path, ex))
+
+    def get(self, adapter):
+        """
+        :param adapter: address of the adapter
+        :return: list of host addresses, most recent first
+        """
+        return list(self.hosts.get(adapter, []))
+
+    def add(self, adapter, host):
+        """
+        Remember a host that has just connected
+        :param adapter: address of the adapter it connected to
+        :param host: address of the host
+        """
+        addresses = self.hosts.get(adapter, [])
+        if addresses[:1] == [host]:
+            return
+        if host in addresses:
+            addresses.remove(host)
+        self.hosts[adapter] = [host, *addresses][:self.limit]
+        self.save()
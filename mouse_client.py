@@ -1,20 +1,31 @@
 import dbus
 import dbus.service
 import dbus.mainloop.glib
-import time
-import evdev  # used to get input from the mouse
-from evdev import InputDevice, ecodes
+from evdev import ecodes
 import argparse
+import logging
+
+from hid_descriptor import MOUSE, HIRES_MOUSE
+from hotplug import DeviceManager, MOUSE as MOUSE_DEVICE
+from input_log import Recorder, MOUSE_EVENTS, REPORTS
+from input_state import MouseState, MAX_DELTA, MAX_HIRES_DELTA, clamp_delta
+from report_state import ReportState
+from report_transport import ReportSender
+from trajectory import Trajectory, PATHS
 
 
 HID_DBUS = 'org.yaptb.btkbservice'
 HID_SRVC = '/org/yaptb/btkbservice'
 
+logger = logging.getLogger('mouse_client')
+
 
 # define a client to listen to local mouse events
-class Mouse:
+class Mouse(MouseState):
 
-    def __init__(self, mode: str, t: float = 0):
+    def __init__(self, mode: str, t: float = 0, use_socket: bool = False,
+                 frames: bool = False, trace: bool = False,
+                 hires: bool = False, recorder: Recorder = None):
         # the structure for a bluetooth mouse input report (size is 6 bytes)
 
         print("Setting up DBus Client")
@@ -22,38 +33,26 @@ class Mouse:
         self.bus = dbus.SystemBus()
         self.bluetoothservice = self.bus.get_object(HID_DBUS, HID_SRVC)
         self.iface = dbus.Interface(self.bluetoothservice, HID_DBUS)
-
-        print("Waiting for mouse")
-
-        # keep trying to find a mouse
-        have_dev = False
-        count = 0
-        NUMBER_OF_TRIES = 100
-
+        # socket or D-Bus path of the reports, with or without tracing.
+        # The simulator sends its batch with send_batch, over D-Bus only
+        self.sender = ReportSender(self.iface, 'send_mouse',
+                                   use_socket and mode != "simulate", trace)
+        # last report sent, unchanged reports are not sent again
+        self.report_state = ReportState()
+        # send the high resolution mouse report: 16 bit movement and
+        # wheels in 1/WHEEL_RESOLUTION detents, one report per frame
+        super().__init__(hires)
+        # accumulate events until SYN_REPORT and send one report per frame
+        self.frames = frames or hires
+        # optional input_log.Recorder of the events or of the reports
+        self.recorder = recorder
+
+        # every mouse plugged in, now or later
+        self.devices = None
         if mode == "mouse":
-            while have_dev is False and count < NUMBER_OF_TRIES:
-                try:
-                    # try and get a mouse - loop through all devices and try to find a mouse
-                    devices = [evdev.InputDevice(fn)
-                               for fn in evdev.list_devices()]
-                    for device in reversed(devices):
-                        if "mouse" in device.name.lower():
-                            print("Found a mouse with the keyword 'mouse'")
-                            print("device name is " + device.name)
-                            self.dev = InputDevice(device.path)
-                            have_dev = True
-                            break
-                except OSError:
-                    print("Mouse not found, waiting 3 seconds and retrying")
-                    time.sleep(3)
-                count += 1
-
-            if not have_dev:
-                print("Mouse not found after " +
-                      str(NUMBER_OF_TRIES) + " tries.")
-                return
-            else:
-                print("Mouse Found")
+            self.devices = DeviceManager((MOUSE_DEVICE,),
+                                         on_attach=self.attach_device,
+                                         on_detach=self.release_buttons)
         self.t = t
 
     state = [
@@ -61,22 +60,17 @@ class Mouse:
         0x02,  # Usage report = Mouse
         # Bit array for Buttons ( Bits 0...4 : Buttons 1...5, Bits 5...7 : Unused )
         0x00,
-        0x00,  # Rel X
-        0x00,  # Rel Y
-        0x00,  # Mouse Wheel
+        0x00,  # Rel X, -127 to 127
+        0x00,  # Rel Y, -127 to 127
+        0x00,  # Mouse Wheel, -127 to 127
     ]
 
     # take care of mouse buttons
     def change_state_button(self, event):
-        if event.code == ecodes.BTN_LEFT:
-            print("Left Mouse Button Pressed")
-            self.state[2] = event.value
-        elif event.code == ecodes.BTN_RIGHT:
-            print("Right Mouse Button Pressed")
-            self.state[2] = 2 * event.value
-        elif event.code == ecodes.BTN_MIDDLE:
-            print("Middle Mouse Button Pressed")
-            self.state[2] = 3 * event.value
+        if not self.button_event(event):
+            return
+        logger.debug("Mouse buttons {:#04x}".format(self.buttons))
+        self.state[2] = self.buttons
         self.state[3] = 0x00
         self.state[4] = 0x00
         self.state[5] = 0x00
@@ -84,53 +78,93 @@ class Mouse:
     # take care of mouse movements
     def change_state_movement(self, event):
         if event.code == ecodes.REL_X:
-            self.state[3] = event.value & 0xFF
+            self.state[3] = clamp_delta(event.value)
         elif event.code == ecodes.REL_Y:
-            self.state[4] = event.value & 0xFF
+            self.state[4] = clamp_delta(event.value)
         elif event.code == ecodes.REL_WHEEL:
-            self.state[5] = event.value & 0xFF
+            self.state[5] = clamp_delta(event.value)
 
-    # poll for mouse events
-    def event_loop(self):
-        for event in self.dev.read_loop():
-            if event.type == ecodes.EV_KEY and event.value < 2:
-                self.change_state_button(event)
-            elif event.type == ecodes.EV_REL:
-                self.change_state_movement(event)
+    # release the buttons, so none stays held when a mouse is unplugged
+    def release_buttons(self, device=None):
+        self.release(device)
+        self.state[2:] = [0x00] * 4
+        self.send_frame()
+
+    # send the reports of the accumulated frame
+    def send_frame(self, event_time=None):
+        for report in self.frame_reports():
             try:
-                self.send_input()
+                self.send_report(report, event_time)
             except Exception:
                 print("Couldn't send mouse input")
+                return
 
-    # silmulate mouse movement using relative cooridinates
-    def simulate_move(self, relX, relY):
-        while relX != 0 or relY != 0:
-            if relX > 0:
-                self.state[3] = 1
-                relX -= 1
-            if relX < 0:
-                self.state[3] = 255
-                relX += 1
-            
-            if relY > 0:
-                self.state[4] = 1
-                relY -= 1
-            if relY < 0:
-                self.state[4]= 255
-                relY += 1
+    # poll for mouse events
+    def event_loop(self):
+        record = self.recorder is not None and self.recorder.kind != REPORTS
+        for device, event in self.devices.events():
+            if record:
+                self.recorder.record_event(event)
+            self.process_event(event, device)
+
+    # update the state with one event, read from a mouse or a log
+    def process_event(self, event, device=None):
+        if self.frames:
+            if self.accumulate_event(event, device):
+                self.send_frame(event.timestamp())
+            return
+        if event.type == ecodes.EV_KEY:
+            self.change_state_button(event)
+        elif event.type == ecodes.EV_REL:
+            self.change_state_movement(event)
+        try:
+            self.send_input(event.timestamp())
+        except Exception:
+            print("Couldn't send mouse input")
+        # the movement has been sent, do not repeat it with the next event
+        self.state[3] = 0x00
+        self.state[4] = 0x00
+        self.state[5] = 0x00
 
-            try:
-                time.sleep(self.t)
-                self.send_input()
-                self.state[3] = 0
-                self.state[4] = 0
-            except Exception:
-                print("Could not send mouse input.")
-                break
+    # silmulate mouse movement using relative cooridinates
+    def simulate_move(self, relX, relY, path="line", duration=None):
+        trajectory = Trajectory(relX, relY, path)
+        max_step = MAX_HIRES_DELTA if self.hires else MAX_DELTA
+        if duration:
+            # enough reports to keep roughly one every self.t seconds, as
+            # few as the movement needs without a report period
+            if self.t > 0:
+                steps = trajectory.plan(max(1, round(duration / self.t)),
+                                        max_step)
+            else:
+                steps = trajectory.plan(max_step=max_step)
+            delay = int(duration / max(1, len(steps)) * 1000000)
+        else:
+            steps = trajectory.plan(max_step=max_step)
+            delay = int(self.t * 1000000)
+
+        # the whole movement is sent in one call and paced by the service
+        if self.hires:
+            batch = [(HIRES_MOUSE.pack(self.state[2], stepX, stepY, 0, 0),
+                      delay) for stepX, stepY in steps]
+        else:
+            batch = [(MOUSE.pack(self.state[2], stepX, stepY, 0), delay)
+                     for stepX, stepY in steps]
+        try:
+            self.iface.send_batch(dbus.Array(batch, signature='(ayu)'))
+        except Exception:
+            print("Could not send mouse input.")
 
     # forward mouse events to the dbus service
-    def send_input(self):
-        self.iface.send_mouse(self.state)
+    def send_input(self, event_time=None):
+        self.send_report(MOUSE.pack(*self.state[2:]), event_time)
+
+    def send_report(self, report, event_time=None):
+        if not self.report_state.changed(report):
+            return
+        if self.recorder is not None and self.recorder.kind == REPORTS:
+            self.recorder.record_report(report)
+        self.sender.send(report, event_time)
 
 
 parser = argparse.ArgumentParser(
@@ -139,16 +173,35 @@ parser.add_argument('--dev', default="mouse", type=str,choices=["mouse", "simula
 parser.add_argument('-x', default=0, type=int, help="Simulator only. Relative x position accepts positive and negative integers. Default is 0")
 parser.add_argument('-y', default=0, type=int, help="Simulator only. Relative y position accepts positive and negative integers. Default is 0")
 parser.add_argument('-t', default=0.05,type=float, help="Simulator only. Time in seconds. Acctepts Float. Higher number means \"pause\" between each steps is longer")
+parser.add_argument('--path', default="line", type=str, choices=PATHS, help="Simulator only. Shape of the movement. Default is line")
+parser.add_argument('--duration', default=None, type=float, help="Simulator only. Target duration of the whole movement in seconds. Default is as few steps as possible, -t apart")
+parser.add_argument('--frames', action='store_true', help="Mouse only. Send one report per input frame instead of one per event")
+parser.add_argument('--hires', action='store_true', help="send the high resolution report: 16 bit movement, high resolution and horizontal wheel. Implies --frames")
+parser.add_argument('--trace', action='store_true', help="send event timestamps for the latency statistics of the service")
+parser.add_argument('--verbose', action='store_true', help="log every mouse event")
+parser.add_argument('--socket', action='store_true', help="Mouse only. Send reports over the local report socket instead of D-Bus")
+parser.add_argument('--record', default=None, type=str, help="Mouse only. Append the mouse events to this input log, see replay.py")
+parser.add_argument('--record-reports', action='store_true', help="Mouse only. Log the reports sent instead of the mouse events")
 
 if __name__ == "__main__":
     print("Setting up mouse Client")
 
     args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING)
     if "mouse" == args.dev:
-        mouse = Mouse("mouse")
+        recorder = None
+        if args.record:
+            recorder = Recorder(args.record,
+                                REPORTS if args.record_reports else MOUSE_EVENTS)
+        mouse = Mouse("mouse", use_socket=args.socket, frames=args.frames,
+                      trace=args.trace, hires=args.hires, recorder=recorder)
         print("Starting mouse event loop")
-        mouse.event_loop()
+        try:
+            mouse.event_loop()
+        finally:
+            if recorder is not None:
+                recorder.close()
     elif "simulate" == args.dev:
-        mouse = Mouse("simulate", args.t)
+        mouse = Mouse("simulate", args.t, hires=args.hires)
         print("Simulating mouse movement")
-        mouse.simulate_move(args.x, args.y)
+        mouse.simulate_move(args.x, args.y, args.path, args.duration)
@@ -0,0 +1,171 @@
+"""
+Profiling of the running service, started and stopped over D-Bus.
+cProfile records every call of the main loop and is written in the
+pstats format. The sampling profiler looks at the stack of the main loop
+from a thread every millisecond and writes collapsed stacks, the input
+of flamegraph.pl and speedscope.
+Hot path timers are only wrapped around their methods while a profile
+runs, the methods are put back when it stops, so they cost nothing the
+rest of the time.
+"""
+import collections
+import cProfile
+import functools
+import os
+import sys
+import threading
+import time
+
+from tracing import LatencyHistogram
+
+CPROFILE = 'cprofile'
+SAMPLING = 'sampling'
+MODES = (CPROFILE, SAMPLING)
+# where a profile is written by default
+DEFAULT_PATHS = {CPROFILE: '/tmp/btkbservice.pstats',
+                 SAMPLING: '/tmp/btkbservice.folded'}
+
+
+class SamplingProfiler(threading.Thread):
+    """
+    Count the stacks of the thread that created it
+    :param interval: seconds between samples
+    """
+
+    def __init__(self, interval=0.001):
+        super().__init__(name='sampling profiler', daemon=True)
+        self.interval = interval
+        self.target = threading.get_ident()
+        # sample counts by tuple of code objects, innermost last
+        self.stacks = collections.Counter()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.target)
+            stack = []
+            while frame is not None:
+                stack.append(frame.f_code)
+                frame = frame.f_back
+            if stack:
+                stack.reverse()
+                self.stacks[tuple(stack)] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    def dump_stats(self, path):
+        """
+        Write the samples as collapsed stacks, one 'outer;...;inner count'
+        line per stack
+        """
+        with open(path, 'w') as fh:
+            for stack, count in self.stacks.most_common():
+                fh.write('{} {}\n'.format(';'.join(
+                    '{} ({}:{})'.format(code.co_name,
+                                        os.path.basename(code.co_filename),
+                                        code.co_firstlineno)
+                    for code in stack), count))
+
+
+def _timed(method, histogram):
+    perf_counter = time.perf_counter
+
+    # wraps keeps the D-Bus attributes of the method
+    @functools.wraps(method)
+    def timed(*args, **kwargs):
+        start = perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            histogram.add(perf_counter() - start)
+    return timed
+
+
+class HotPathTimers:
+    """
+    Time methods by replacing them with timed wrappers while enabled
+    :param targets: dict of (class, method name) by timer name
+    """
+
+    def __init__(self, targets):
+        self.targets = targets
+        self.histograms = {}
+        self.originals = {}
+
+    def enable(self):
+        self.histograms = {name: LatencyHistogram() for name in self.targets}
+        for name, (owner, attribute) in self.targets.items():
+            original = owner.__dict__[attribute]
+            self.originals[name] = original
+            setattr(owner, attribute, _timed(original,
+                                             self.histograms[name]))
+
+    def disable(self):
+        for name, original in self.originals.items():
+            owner, attribute = self.targets[name]
+            setattr(owner, attribute, original)
+        self.originals = {}
+
+    def summary(self):
+        return {name: histogram.summary()
+                for name, histogram in self.histograms.items()
+                if histogram.count}
+
+
+class Profiler:
+    """
+    One profile at a time, of the thread that starts it, together with
+    the hot path timers
+    :param timers: HotPathTimers
+    """
+
+    def __init__(self, timers):
+        self.timers = timers
+        self.mode = None
+        self.path = None
+        self.profile = None
+
+    @property
+    def running(self):
+        return self.mode is not None
+
+    def start(self, mode=CPROFILE, path=None):
+        """
+        :param mode: CPROFILE or SAMPLING
+        :param path: file the profile is written to, see DEFAULT_PATHS
+        :raise ValueError: for an unknown mode
+        :raise RuntimeError: if a profile is running already
+        """
+        if mode not in MODES:
+            raise ValueError('Unknown profiler {}, use one of {}'.format(
+                mode, ', '.join(MODES)))
+        if self.running:
+            raise RuntimeError('The {} profiler is running already'.format(
+                self.mode))
+        self.path = path or DEFAULT_PATHS[mode]
+        if mode == CPROFILE:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        else:
+            self.profile = SamplingProfiler()
+            self.profile.start()
+        self.mode = mode
+        self.timers.enable()
+
+    def stop(self):
+        """
+        Stop the profile and write it
+        :return: path of the file written
+        :raise OSError: if the file can not be written
+        """
+        self.timers.disable()
+        if self.mode == CPROFILE:
+            self.profile.disable()
+        else:
+            self.profile.stop()
+        profile = self.profile
+        self.mode = self.profile = None
+        profile.dump_stats(self.path)
+        return self.path
@@ -0,0 +1,119 @@
+#!/usr/bin/python3
+"""
+Replay an input log recorded by kb_client.py or mouse_client.py with
+--record.
+The log is memory mapped and read one record at a time, so captures of
+any length replay in constant memory. Logs of reports are sent to the
+service as they are, logs of evdev events go through the keyboard or
+mouse client as if they came from the device again.
+"""
+import argparse
+import time
+
+import dbus
+import evdev
+
+from input_log import InputLog, KEYBOARD_EVENTS, REPORTS
+from report_transport import ReportSocket
+
+HID_DBUS = 'org.yaptb.btkbservice'
+HID_SRVC = '/org/yaptb/btkbservice'
+
+BUSY_ERROR = 'org.yaptb.btkbservice.Error.Busy'
+# wait before sending a report again when the host queue is full
+BUSY_DELAY = 0.005
+
+
+def replay(log, send, speed=1.0):
+    """
+    Pass the records of a log to send at the pace they were recorded
+    :param log: InputLog
+    :param send: function called with each record
+    :param speed: 2.0 replays twice as fast, 0 as fast as possible
+    :return: number of records sent
+    """
+    count = 0
+    start = None
+    for record in log:
+        if speed:
+            if start is None:
+                start = time.monotonic() - record[0] / speed
+            delay = start + record[0] / speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        send(record)
+        count += 1
+    return count
+
+
+def report_sender(use_socket=False):
+    """
+    :param use_socket: send over the report socket instead of D-Bus
+    :return: function sending a (time, report) record to the service
+    """
+    if use_socket:
+        report_socket = ReportSocket()
+        return lambda record: report_socket.send(record[1])
+
+    btk_service = dbus.Interface(
+        dbus.SystemBus().get_object(HID_DBUS, HID_SRVC), HID_DBUS)
+
+    def send(record):
+        report = dbus.ByteArray(record[1])
+        while True:
+            try:
+                btk_service.send_keys(report, signature='ay')
+                return
+            except dbus.DBusException as ex:
+                if ex.get_dbus_name() != BUSY_ERROR:
+                    raise
+                time.sleep(BUSY_DELAY)
+    return send
+
+
+def event_sender(client):
+    """
+    :param client: kb_client.Kbrd or mouse_client.Mouse
+    :return: function passing a (time, type, code, value) record to it
+    """
+    def send(record):
+        stamp, type_, code, value = record
+        sec = int(stamp)
+        client.process_event(evdev.InputEvent(
+            sec, int(round((stamp - sec) * 1000000)), type_, code, value))
+    return send
+
+
+parser = argparse.ArgumentParser(
+    description="Replays an input log to the HID service")
+parser.add_argument('log', type=str, help="input log written with --record")
+parser.add_argument('--speed', default=1.0, type=float, help="replay speed, 2 is twice as fast, 0 is as fast as possible. Default is 1")
+parser.add_argument('--socket', action='store_true', help="send reports over the local report socket instead of D-Bus")
+parser.add_argument('--profile', default=None, type=str, help="Keyboard events only. JSON file remapping keys")
+parser.add_argument('--nkro', action='store_true', help="Keyboard events only. Send N-key rollover reports")
+parser.add_argument('--frames', action='store_true', help="Mouse events only. Send one report per input frame")
+parser.add_argument('--hires', action='store_true', help="Mouse events only. Send the high resolution mouse report")
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    log = InputLog(args.log)
+    if log.kind == REPORTS:
+        send = report_sender(args.socket)
+    elif log.kind == KEYBOARD_EVENTS:
+        from kb_client import Kbrd
+        send = event_sender(Kbrd(use_socket=args.socket, profile=args.profile,
+                                 nkro=args.nkro, watch=False))
+    else:
+        from mouse_client import Mouse
+        send = event_sender(Mouse("replay", use_socket=args.socket,
+                                  frames=args.frames, hires=args.hires))
+
+    print('Replaying {} records'.format(len(log)))
+    start = time.monotonic()
+    try:
+        count = replay(log, send, args.speed)
+    finally:
+        log.close()
+    print('Sent {} records in {:.3f} s'.format(count,
+                                               time.monotonic() - start))
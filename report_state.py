@@ -0,0 +1,43 @@
+"""
+Change suppression of HID reports.
+The last report sent is kept per report ID and a new report is only sent
+when it differs. Relative fields (mouse movement) are not state: a report
+that moves something is always sent, one that does not is compared with
+the last report with its relative fields cleared.
+"""
+import hid_descriptor
+
+# bytes of the relative fields per report ID
+RELATIVE_FIELDS = hid_descriptor.relative_fields()
+
+
+class ReportState:
+    """
+    Last report sent per report ID
+    """
+
+    def __init__(self):
+        self.last = {}
+        self.suppressed = 0
+
+    def changed(self, report):
+        """
+        Check a report and remember it if it is going to be sent
+        :param report: (bytes or list of ints) HID packet
+        :return: True if the report has to be sent
+        """
+        report = bytes(report)
+        relative = RELATIVE_FIELDS.get(report[1])
+        if relative is not None and any(report[relative]):
+            cleared = bytearray(report)
+            cleared[relative] = bytes(len(cleared[relative]))
+            self.last[report[1]] = bytes(cleared)
+            return True
+        if self.last.get(report[1]) == report:
+            self.suppressed += 1
+            return False
+        self.last[report[1]] = report
+        return True
+
+    def clear(self):
+        self.last.clear()
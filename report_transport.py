@@ -0,0 +1,80 @@
+"""
+Low latency report transport between the HID clients and the
+Bluetooth HID D-Bus service.
+Every packet written to the socket is one raw HID report, exactly the
+bytes that would otherwise be passed to send_keys/send_mouse over D-Bus.
+Writes are fire-and-forget, there is no reply from the service.
+A traced report is prefixed with TRACE_HEADER, the magic byte can not be
+the first byte of a report as those start with the 0xA1 DATA header.
+"""
+import socket
+import struct
+import time
+
+# Unix socket the service listens on for raw reports
+REPORT_SOCKET_PATH = '/run/btkbservice.sock'
+# Largest report accepted on the socket
+MAX_REPORT_SIZE = 64
+# magic byte, evdev event time, client send time
+TRACE_MAGIC = 0x54
+TRACE_HEADER = struct.Struct('<Bdd')
+
+
+class ReportSocket:
+    """
+    Client side of the report socket
+    """
+
+    def __init__(self, path=REPORT_SOCKET_PATH):
+        self.path = path
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.sock.connect(path)
+
+    def send(self, report, event_time=None):
+        """
+        Send one HID report to the service
+        :param report: (bytes or list of ints) HID packet to send
+        :param event_time: evdev timestamp of the input event, the report
+        is traced by the service if it is given
+        """
+        if event_time is None:
+            self.sock.send(bytes(report))
+        else:
+            self.sock.send(TRACE_HEADER.pack(TRACE_MAGIC, event_time,
+                                             time.time()) + bytes(report))
+
+    def close(self):
+        self.sock.close()
+
+
+class ReportSender:
+    """
+    Send the reports of a client to the service, over the report socket
+    or over D-Bus
+    :param iface: dbus.Interface of the service
+    :param method: D-Bus method of the reports, 'send_keys' or 'send_mouse'
+    :param use_socket: send over the report socket instead of D-Bus
+    :param trace: send the evdev timestamps along for latency tracing
+    """
+
+    def __init__(self, iface, method, use_socket=False, trace=False):
+        self.iface = iface
+        self.method = method
+        # optional fire-and-forget path for the reports
+        self.report_socket = ReportSocket() if use_socket else None
+        self.trace = trace
+
+    def send(self, report, event_time=None):
+        """
+        :param report: (bytes) HID packet to send
+        :param event_time: evdev timestamp of the input event, only sent
+        when tracing
+        """
+        if not self.trace:
+            event_time = None
+        if self.report_socket is not None:
+            self.report_socket.send(report, event_time)
+        elif event_time is not None:
+            self.iface.send_traced(report, event_time, time.time())
+        else:
+            getattr(self.iface, self.method)(report)
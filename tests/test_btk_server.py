@@ -0,0 +1,184 @@
+import collections
+
+import pytest
+
+pytest.importorskip('dbus')
+pytest.importorskip('gi')
+
+import btk_server  # noqa: E402
+import hid_descriptor  # noqa: E402
+
+
+def drain(queue):
+    reports = []
+    while queue:
+        reports.append(queue.peek())
+        queue.pop()
+    return reports
+
+
+def test_mouse_motion_kept_after_overflow():
+    counters = collections.Counter()
+    queue = btk_server.SendQueue(counters)
+    for _ in range(40):
+        queue.push(hid_descriptor.MOUSE.pack(0, 120, 0, 0))
+    # a new button state every report overflows the button states
+    for seq in range(2 * btk_server.SendQueue.MOUSE_LIMIT):
+        queue.push(hid_descriptor.MOUSE.pack(seq & 1, -100, 50, 0))
+    moves = [hid_descriptor.MOUSE.unpack(report)[1:3]
+             for report in drain(queue)]
+    assert counters['dropped'] > 0
+    assert sum(x for x, _ in moves) == 40 * 120 \
+        - 2 * btk_server.SendQueue.MOUSE_LIMIT * 100
+    assert sum(y for _, y in moves) == \
+        2 * btk_server.SendQueue.MOUSE_LIMIT * 50
+    low, high = hid_descriptor.MOUSE.relative_limits[0]
+    assert all(low <= x <= high for x, _ in moves)
+
+
+def test_keyboard_reports_go_first_in_order():
+    queue = btk_server.SendQueue(collections.Counter())
+    queue.push(hid_descriptor.MOUSE.pack(0, 1, 0, 0))
+    keys = [hid_descriptor.KEYBOARD.pack(0, key, 0, 0, 0, 0, 0)
+            for key in (4, 5)]
+    for report in keys:
+        queue.push(report)
+    assert drain(queue)[:2] == keys
+
+
+def test_refused_mouse_report_raises_busy(monkeypatch):
+    service = btk_server.BTKbService.__new__(btk_server.BTKbService)
+    monkeypatch.setattr(service, 'send', lambda report: False,
+                        raising=False)
+    with pytest.raises(btk_server.BusyError):
+        service.send_mouse(hid_descriptor.MOUSE.pack(0, 1, 0, 0))
+
+
+class FakeConnection:
+
+    def __init__(self, address):
+        self.address = address
+        self.connected = True
+        self.sent = []
+
+        self.counters = collections.Counter()
+
+    def send(self, msg):
+        self.sent.append(bytes(msg))
+
+    def close(self):
+        self.connected = False
+
+
+class FakeDevice:
+
+    def __init__(self, *addresses):
+        self.connections = {address: FakeConnection(address)
+                            for address in addresses}
+        self.scheduler = None
+        self.active = None
+
+    targets = btk_server.BTKbDevice.targets
+
+
+def kvm_service(*devices):
+    service = btk_server.BTKbService.__new__(btk_server.BTKbService)
+    service.devices = list(devices)
+    service.active_host = None
+    service.pacer = btk_server.ReportPacer(service)
+    service.ActiveHostChanged = lambda address: None
+    return service
+
+
+def test_switch_releases_only_hosts_that_stop_getting_reports():
+    device = FakeDevice('AA:AA:AA:AA:AA:AA', 'BB:BB:BB:BB:BB:BB')
+    first, second = device.connections.values()
+    service = kvm_service(device)
+    service.switch_host(second.address)
+    assert len(first.sent) == len(hid_descriptor.REPORTS)
+    assert second.sent == []
+    first.sent.clear()
+    service.switch_host(None)
+    assert first.sent == [] and second.sent == []
+
+
+def test_active_host_lost_falls_back_to_all_hosts():
+    device = btk_server.BTKbDevice.__new__(btk_server.BTKbDevice)
+    device.connections = {address: FakeConnection(address) for address
+                          in ('AA:AA:AA:AA:AA:AA', 'BB:BB:BB:BB:BB:BB')}
+    device.counters = collections.Counter()
+    device.known_hosts = None
+    device.scheduler = None
+    device.active = None
+    service = kvm_service(device)
+    changes = []
+    service.ActiveHostChanged = changes.append
+    device.active_lost = service._active_lost
+    first, second = device.connections.values()
+    service.switch_host(second.address)
+    device.on_disconnect(second)
+    assert service.active_host is None and device.active is None
+    assert device.targets() == [first]
+    assert changes == [second.address, '']
+
+
+def test_hosts_keep_their_order_when_they_reconnect():
+    device = FakeDevice('CC:CC:CC:CC:CC:CC', 'AA:AA:AA:AA:AA:AA',
+                        'BB:BB:BB:BB:BB:BB')
+    service = kvm_service(device)
+    hosts = list(service.get_hosts())
+    # a reconnect puts the host at the end of the connections
+    device.connections['AA:AA:AA:AA:AA:AA'] = \
+        device.connections.pop('AA:AA:AA:AA:AA:AA')
+    assert list(service.get_hosts()) == hosts == sorted(hosts)
+
+
+class FakeSocket:
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, data):
+        self.sent.append(bytes(data))
+
+
+def control_connection():
+    device = btk_server.BTKbDevice.__new__(btk_server.BTKbDevice)
+    device.dedup = False
+    connection = btk_server.HostConnection(device, 'AA:AA:AA:AA:AA:AA')
+    connection.ccontrol = FakeSocket()
+    return connection
+
+
+def get_report(connection, report_type, report_id):
+    connection._control(bytes([btk_server.HIDP_GET_REPORT << 4 | report_type,
+                               report_id]))
+    return connection.ccontrol.sent[-1]
+
+
+def handshake(result):
+    return bytes([btk_server.HIDP_HANDSHAKE << 4 | result])
+
+
+def test_get_report_input():
+    connection = control_connection()
+    report = hid_descriptor.KEYBOARD.pack(0, 4, 0, 0, 0, 0, 0)
+    connection.last_reports[btk_server.KEYBOARD_REPORT] = report
+    assert get_report(connection, btk_server.HIDP_INPUT,
+                      btk_server.KEYBOARD_REPORT) == report
+    assert get_report(connection, btk_server.HIDP_INPUT,
+                      btk_server.MOUSE_REPORT) \
+        == bytes(hid_descriptor.MOUSE.buffer())
+
+
+def test_get_report_unknown_id():
+    connection = control_connection()
+    assert get_report(connection, btk_server.HIDP_INPUT, 0x7F) \
+        == handshake(btk_server.HIDP_INVALID_REPORT_ID)
+
+
+def test_get_report_other_type():
+    connection = control_connection()
+    assert get_report(connection, btk_server.HIDP_OTHER,
+                      btk_server.KEYBOARD_REPORT) \
+        == handshake(btk_server.HIDP_INVALID_PARAMETER)
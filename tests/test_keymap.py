@@ -0,0 +1,26 @@
+import json
+
+import pytest
+
+import keymap
+
+
+def write_profile(tmp_path, remap):
+    path = tmp_path / 'profile.json'
+    path.write_text(json.dumps({'remap': remap}))
+    return str(path)
+
+
+def test_profile_remaps_to_key_and_usage(tmp_path):
+    table = keymap.load_profile(write_profile(
+        tmp_path, {'KEY_CAPSLOCK': 'KEY_LEFTCTRL', 'KEY_F13': 104}))
+    assert table[keymap.ecodes.KEY_CAPSLOCK] \
+        == table[keymap.ecodes.KEY_LEFTCTRL]
+    assert table[keymap.ecodes.KEY_F13] == 104
+
+
+@pytest.mark.parametrize('usage', [-1, 0x100, 0x10000])
+def test_profile_with_bad_usage(tmp_path, usage):
+    path = write_profile(tmp_path, {'KEY_F13': usage})
+    with pytest.raises(ValueError, match='KEY_F13'):
+        keymap.load_profile(path)
@@ -0,0 +1,97 @@
+"""
+Latency tracing of reports from the input device to the L2CAP socket.
+A traced report carries the evdev timestamp of the input event and the
+time the client sent it. The service adds the time it received it and
+records every stage in a histogram once the report is on the socket.
+All times are wall clock seconds, the same clock evdev timestamps use.
+"""
+import bisect
+
+# stages of a report, in order
+STAGES = ('client', 'ipc', 'queue', 'send', 'total')
+
+
+class TracedReport(bytes):
+    """
+    HID report bytes that remember when they were created
+    """
+
+    def __new__(cls, report, trace):
+        traced = super().__new__(cls, report)
+        # (event time, client send time, service receive time)
+        traced.trace = trace
+        return traced
+
+
+class LatencyHistogram:
+    """
+    Histogram of latencies with power of two microsecond buckets
+    """
+    # upper bounds of the buckets in microseconds, 1us up to ~16s
+    BOUNDS = [1 << i for i in range(25)]
+
+    def __init__(self):
+        self.buckets = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        micros = max(0.0, seconds * 1000000)
+        self.buckets[bisect.bisect_left(self.BOUNDS, micros)] += 1
+        self.count += 1
+        self.total += micros
+        if micros > self.max:
+            self.max = micros
+
+    def percentile(self, fraction):
+        """
+        :param fraction: 0.5 for the median
+        :return: upper bound in microseconds of the bucket holding it
+        """
+        if not self.count:
+            return 0.0
+        wanted = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.BOUNDS, self.buckets):
+            seen += count
+            if seen >= wanted:
+                return float(min(bound, self.max))
+        return self.max
+
+    def summary(self):
+        return {
+            'count': float(self.count),
+            'mean_us': self.total / self.count if self.count else 0.0,
+            'p50_us': self.percentile(0.5),
+            'p90_us': self.percentile(0.9),
+            'p99_us': self.percentile(0.99),
+            'max_us': self.max,
+        }
+
+
+class LatencyTracer:
+    """
+    Latency histograms of every stage
+    """
+
+    def __init__(self):
+        self.stages = {stage: LatencyHistogram() for stage in STAGES}
+
+    def record(self, trace, send_start, send_end):
+        """
+        Add a report that has been written to the socket
+        :param trace: (event, client, received) times of the report
+        :param send_start: time the socket send was started
+        :param send_end: time the socket send returned
+        """
+        event, client, received = trace
+        self.stages['client'].add(client - event)
+        self.stages['ipc'].add(received - client)
+        self.stages['queue'].add(send_start - received)
+        self.stages['send'].add(send_end - send_start)
+        self.stages['total'].add(send_end - event)
+
+    def summary(self):
+        return {stage: histogram.summary()
+                for stage, histogram in self.stages.items()}
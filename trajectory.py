@@ -0,0 +1,82 @@
+"""
+Trajectory planning for simulated mouse movement.
+A path from (0, 0) to (relX, relY) is sampled once for the whole movement
+and turned into per report relative steps. Positions are rounded on the
+cumulative path, so the rounding remainder of one step carries over to the
+next and the pointer always ends exactly on the target.
+"""
+import math
+
+# largest relative movement that fits in one mouse report
+MAX_STEP = 127
+
+PATHS = ('line', 'bezier', 'ease')
+
+
+class Trajectory:
+    """
+    Path of a relative mouse movement
+    :param relX: total movement on the X axis
+    :param relY: total movement on the Y axis
+    :param path: one of PATHS
+    :param bend: bezier only, how far the curve bows away from the straight
+    line as a fraction of its length. Negative values bow the other way
+    """
+
+    def __init__(self, relX, relY, path='line', bend=0.25):
+        if path not in PATHS:
+            raise ValueError('Unknown path {}'.format(path))
+        self.relX = relX
+        self.relY = relY
+        self.path = path
+        # control points of the cubic bezier, offset perpendicular to the line
+        self.control = ((relX / 3 - bend * relY, relY / 3 + bend * relX),
+                        (2 * relX / 3 - bend * relY, 2 * relY / 3 + bend * relX))
+
+    def positions(self, steps):
+        """
+        Sample the path
+        :param steps: number of reports the movement is split into
+        :return: (xs, ys) lists of steps + 1 rounded cumulative positions
+        """
+        us = [i / steps for i in range(steps + 1)]
+        if self.path == 'line':
+            xs = [self.relX * u for u in us]
+            ys = [self.relY * u for u in us]
+        elif self.path == 'ease':
+            # smoothstep, slow start and slow stop
+            ss = [u * u * (3 - 2 * u) for u in us]
+            xs = [self.relX * s for s in ss]
+            ys = [self.relY * s for s in ss]
+        else:
+            (x1, y1), (x2, y2) = self.control
+            w1 = [3 * (1 - u) * (1 - u) * u for u in us]
+            w2 = [3 * (1 - u) * u * u for u in us]
+            w3 = [u * u * u for u in us]
+            xs = [a * x1 + b * x2 + c * self.relX
+                  for a, b, c in zip(w1, w2, w3)]
+            ys = [a * y1 + b * y2 + c * self.relY
+                  for a, b, c in zip(w1, w2, w3)]
+        return [round(x) for x in xs], [round(y) for y in ys]
+
+    def plan(self, steps=1, max_step=MAX_STEP):
+        """
+        Split the movement into relative steps that each fit in a report
+        :param steps: requested number of reports, raised if the steps
+        would not fit in max_step
+        :param max_step: largest movement a report holds
+        :return: list of (dx, dy) tuples
+        """
+        if self.relX == 0 and self.relY == 0:
+            return []
+        steps = max(steps, math.ceil(max(abs(self.relX),
+                                         abs(self.relY)) / max_step))
+        while True:
+            xs, ys = self.positions(steps)
+            dxs = [b - a for a, b in zip(xs, xs[1:])]
+            dys = [b - a for a, b in zip(ys, ys[1:])]
+            largest = max(max(map(abs, dxs)), max(map(abs, dys)))
+            if largest <= max_step:
+                return list(zip(dxs, dys))
+            # curves move faster than the straight line in places
+            steps = math.ceil(steps * largest / max_step) + 1